@@ -0,0 +1,230 @@
+import os
+import logging
+import secrets
+from multiprocessing import AuthenticationError
+from multiprocessing.connection import Listener, Client
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import whisper
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+# 常驻服务的认证密钥文件（位于 base.cache_dir）；连接双方收发的对象会被反序列化，密钥不能公开
+AUTHKEY_FILE = "asr_worker.key"
+TRANSCRIBE_OPTIONS = {"temperature": 0.6, "language": "zh"}
+
+_models = {}
+
+def load_whisper_model(model_name, device=None):
+    """同一进程内每个 Whisper 模型只加载一次；device 为 None 时由 Whisper 自动选择"""
+    key = (model_name, device)
+    if key not in _models:
+        logging.info(f"加载 Whisper 模型 {model_name}...")
+        _models[key] = whisper.load_model(model_name, device=device)
+    return _models[key]
+
+def load_worker_authkey(cache_dir):
+    """
+    读取常驻 ASR 服务的认证密钥；首次使用时生成随机密钥，以仅当前用户可读写（0600）的权限写入 cache_dir
+    服务端与客户端从同一个 cache_dir 读取，其他本地用户无法得到密钥，也就无法向服务发送任意对象
+    """
+    path = os.path.join(cache_dir, AUTHKEY_FILE)
+    os.makedirs(cache_dir, exist_ok=True)
+    try:
+        fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+    except FileExistsError:
+        pass
+    else:
+        with os.fdopen(fd, "w") as f:
+            f.write(secrets.token_hex(32))
+    with open(path, "r") as f:
+        authkey = f.read().strip()
+    if not authkey:
+        raise ValueError(f"ASR 服务密钥文件 {path} 为空，删除后重新运行会生成新的密钥")
+    return authkey.encode("ascii")
+
+def transcribe(audio_path, model_name, device=None):
+    """在当前进程内转写音频，返回 Whisper 的 segments"""
+    model = load_whisper_model(model_name, device)
+    result = model.transcribe(audio_path, **TRANSCRIBE_OPTIONS)
+    return result["segments"]
+
+def find_silence_cuts(audio, sample_rate=whisper.audio.SAMPLE_RATE, chunk_seconds=60, frame_ms=30, min_silence_ms=400):
+    """
+    基于短时能量的静音切分：按帧计算 RMS，低于自适应阈值且持续 min_silence_ms 的区间视为静音，
+    在静音中点处切分，使每块尽量接近但不超过 chunk_seconds；找不到静音时在 chunk_seconds 处硬切
+
+    Returns:
+        List[tuple]: 每块的 (起始采样点, 结束采样点)
+    """
+    frame_len = int(sample_rate * frame_ms / 1000)
+    n_frames = len(audio) // frame_len
+    if n_frames == 0:
+        return [(0, len(audio))]
+    frames = audio[:n_frames * frame_len].reshape(n_frames, frame_len)
+    rms = np.sqrt(np.mean(frames.astype(np.float32) ** 2, axis=1))
+    threshold = max(float(np.percentile(rms, 10)) * 3, 1e-4)
+    silent = rms < threshold
+
+    # 找出足够长的静音区间，记录其中点（采样点）
+    candidates = []
+    min_frames = max(1, min_silence_ms // frame_ms)
+    edges = np.diff(np.concatenate(([0], silent.astype(np.int8), [0])))
+    for run_start, run_end in zip(np.flatnonzero(edges == 1), np.flatnonzero(edges == -1)):
+        if run_end - run_start >= min_frames:
+            candidates.append((run_start + run_end) // 2 * frame_len)
+
+    max_len = int(chunk_seconds * sample_rate)
+    spans = []
+    start = 0
+    idx = 0
+    while len(audio) - start > max_len:
+        limit = start + max_len
+        cut = None
+        while idx < len(candidates) and candidates[idx] <= limit:
+            if candidates[idx] > start:
+                cut = candidates[idx]
+            idx += 1
+        if cut is None:
+            cut = limit
+        spans.append((start, cut))
+        start = cut
+    spans.append((start, len(audio)))
+    return spans
+
+def _init_chunk_worker(model_name, device):
+    load_whisper_model(model_name, device)
+
+def _transcribe_chunk(model_name, device, chunk, offset):
+    model = load_whisper_model(model_name, device)
+    segments = model.transcribe(chunk, **TRANSCRIBE_OPTIONS)["segments"]
+    for seg in segments:
+        seg["start"] += offset
+        seg["end"] += offset
+    return segments
+
+def iter_transcribe_chunked(audio_path, model_name, workers=1, chunk_seconds=60, device=None, worker_address=None, done_chunks=None, on_chunk=None):
+    """
+    按静音切分音频后转写，每块完成后立即按顺序逐个产出 segments（时间戳已平移回全局时间）
+    workers > 1 时各块在进程池中并行转写；否则依次交给 worker_address（(host, port, authkey)）上的常驻服务，
+    服务未运行时在当前进程内转写。三种方式切分相同，流式与批处理得到相同结构的识别结果
+
+    done_chunks: {(起始采样点, 结束采样点): segments}，已转写过的块（如从日志恢复）直接复用，不再转写
+    on_chunk: 每块新转写完成时按顺序调用 on_chunk((起始采样点, 结束采样点), segments)
+    """
+    audio = whisper.load_audio(audio_path)
+    sample_rate = whisper.audio.SAMPLE_RATE
+    spans = find_silence_cuts(audio, sample_rate, chunk_seconds)
+    done_chunks = done_chunks or {}
+    reused = sum(span in done_chunks for span in spans)
+    logging.info(f"音频按静音切分为 {len(spans)} 块，使用 {workers} 个进程转写" + (f"，其中 {reused} 块从日志恢复" if reused else ""))
+
+    state = {"use_worker": worker_address is not None, "next_id": 0}
+
+    def transcribe_span(span):
+        start, end = span
+        if span in done_chunks:
+            return done_chunks[span]
+        segments = None
+        if state["use_worker"]:
+            segments = request_chunk_transcription(*worker_address, audio[start:end], start / sample_rate, model_name)
+            if segments is None:
+                logging.info("未检测到常驻 ASR 服务，在当前进程内加载模型")
+                state["use_worker"] = False
+        if segments is None:
+            segments = _transcribe_chunk(model_name, device, audio[start:end], start / sample_rate)
+        return segments
+
+    def finish(span, segments):
+        if on_chunk is not None and span not in done_chunks:
+            on_chunk(span, segments)
+        for seg in segments:
+            seg["id"] = state["next_id"]
+            state["next_id"] += 1
+        return segments
+
+    pending = [span for span in spans if span not in done_chunks]
+    if workers <= 1 or not pending:
+        for span in spans:
+            yield from finish(span, transcribe_span(span))
+        return
+
+    with ProcessPoolExecutor(max_workers=min(workers, len(pending)), initializer=_init_chunk_worker, initargs=(model_name, device)) as executor:
+        futures = {
+            span: executor.submit(_transcribe_chunk, model_name, device, audio[span[0]:span[1]], span[0] / sample_rate)
+            for span in pending
+        }
+        for span in spans:
+            segments = futures[span].result() if span in futures else done_chunks[span]
+            yield from finish(span, segments)
+
+def transcribe_chunked(audio_path, model_name, workers, chunk_seconds=60, device=None, worker_address=None, done_chunks=None, on_chunk=None):
+    """
+    按静音切分音频后转写（多进程并行或交给常驻服务），各块时间戳平移回全局时间后按顺序拼接
+    输出与 transcribe 相同的 segments 结构
+    """
+    return list(iter_transcribe_chunked(audio_path, model_name, workers, chunk_seconds, device, worker_address, done_chunks, on_chunk))
+
+def serve(host, port, authkey, preload=None, device=None):
+    """
+    常驻 ASR 服务：模型加载后保留在内存中，逐个处理本地 socket 上的转写请求
+    只接受持有 authkey（load_worker_authkey）的连接
+    preload 与所有请求的模型都在 device 上运行（None 时由 Whisper 自动选择）
+    请求: {"audio_path": 绝对路径, "model": 模型名}，转写整个文件；
+          或 {"audio": 音频块, "offset": 起始秒数, "model": 模型名}，转写一个音频块，时间戳平移 offset
+    响应: {"ok": True, "segments": [...]} 或 {"ok": False, "error": 错误信息}
+    """
+    if preload:
+        load_whisper_model(preload, device)
+    with Listener((host, port), authkey=authkey) as listener:
+        logging.info(f"ASR 服务已启动: {host}:{port}")
+        while True:
+            try:
+                conn = listener.accept()
+            except (AuthenticationError, EOFError, ConnectionResetError) as e:
+                logging.warning(f"拒绝未通过认证的连接: {e}")
+                continue
+            with conn:
+                try:
+                    job = conn.recv()
+                    if "audio" in job:
+                        logging.info(f"收到转写任务: {job['offset']:.1f} 秒起的音频块")
+                        segments = _transcribe_chunk(job["model"], device, job["audio"], job["offset"])
+                    else:
+                        logging.info(f"收到转写任务: {job['audio_path']}")
+                        segments = transcribe(job["audio_path"], job["model"], device)
+                    conn.send({"ok": True, "segments": segments})
+                except (EOFError, ConnectionResetError):
+                    continue
+                except Exception as e:
+                    logging.error(f"转写失败: {e}")
+                    conn.send({"ok": False, "error": str(e)})
+
+def _request(host, port, authkey, job):
+    try:
+        conn = Client((host, port), authkey=authkey)
+    except (ConnectionRefusedError, FileNotFoundError, OSError):
+        return None
+    with conn:
+        conn.send(job)
+        response = conn.recv()
+    if not response["ok"]:
+        raise RuntimeError(f"ASR 服务转写失败: {response['error']}")
+    return response["segments"]
+
+def request_transcription(host, port, authkey, audio_path, model_name):
+    """
+    向常驻 ASR 服务提交整个文件的转写任务
+    服务未启动时返回 None，由调用方回退到进程内转写
+    """
+    return _request(host, port, authkey, {"audio_path": os.path.abspath(audio_path), "model": model_name})
+
+def request_chunk_transcription(host, port, authkey, chunk, offset, model_name):
+    """向常驻 ASR 服务提交一个音频块，返回平移到全局时间的 segments；服务未启动时返回 None"""
+    return _request(host, port, authkey, {"audio": chunk, "offset": offset, "model": model_name})
+
+if __name__ == "__main__":
+    import yaml
+    config = yaml.load(open("config/config.yaml", "r", encoding="utf-8"), Loader=yaml.FullLoader)
+    asr_config = config["model"]["asr"]
+    authkey = load_worker_authkey(config["base"]["cache_dir"])
+    serve(asr_config["worker_host"], asr_config["worker_port"], authkey, preload=asr_config["whisper"], device=asr_config["device"])
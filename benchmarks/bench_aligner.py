@@ -0,0 +1,126 @@
+"""
+本地对齐器（align_to_script）的准确率与吞吐基准
+    准确率：在样例（story.txt、asr_result.json 与 LLM 对齐后的 subtitles.json）上比较本地对齐结果与 LLM 结果，
+           可用 --fixture 指向任意已完成故事的输出目录（含这三个文件）
+    吞吐：在合成剧本上按分句生成带替换/漏字/多字错误、去掉标点的识别结果，测量对齐耗时、进程内存峰值
+         与相对真实分句的准确率；输出使用的锚点间隙带宽
+
+用法（在项目根目录运行）：
+    python benchmarks/bench_aligner.py [--fixture DIR ...] [--sizes 5000 20000 50000 100000] [--band 100]
+"""
+import os
+import re
+import sys
+import json
+import time
+import random
+import resource
+import argparse
+from difflib import SequenceMatcher
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from utils.aligner import align_to_script, ALIGN_BAND
+from utils.tools import clean_zh_text
+
+FIXTURE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fixtures", "align_sample")
+
+def score(texts, references):
+    """清洗后逐条比较：完全一致的比例，以及平均字符相似度"""
+    exact = 0
+    similarity = 0.0
+    for text, reference in zip(texts, references):
+        a, b = clean_zh_text(text), clean_zh_text(reference)
+        exact += a == b
+        similarity += SequenceMatcher(None, a, b, autojunk=False).ratio()
+    return exact / len(references), similarity / len(references)
+
+def bench_fixture(fixture_dir, min_confidence, band):
+    with open(os.path.join(fixture_dir, "story.txt"), "r", encoding="utf-8") as f:
+        script = f.read()
+    with open(os.path.join(fixture_dir, "asr_result.json"), "r", encoding="utf-8") as f:
+        asr_result = json.load(f)
+    with open(os.path.join(fixture_dir, "subtitles.json"), "r", encoding="utf-8") as f:
+        llm_result = json.load(f)
+    if len(asr_result) != len(llm_result):
+        raise ValueError(f"{fixture_dir}: 识别结果 {len(asr_result)} 条，LLM 结果 {len(llm_result)} 条，无法逐条比较")
+
+    t0 = time.perf_counter()
+    aligned, confidences = align_to_script(asr_result, script, band)
+    seconds = time.perf_counter() - t0
+    references = [item["text"] for item in llm_result]
+    asr_exact, asr_similarity = score([seg["text"] for seg in asr_result], references)
+    exact, similarity = score([item["text"] for item in aligned], references)
+    timing_kept = all((a["start"], a["end"], a["duration"]) == (s["start"], s["end"], s["duration"]) for a, s in zip(aligned, asr_result))
+    low = sum(confidence < min_confidence for confidence in confidences)
+    print(f"样例 {os.path.relpath(fixture_dir)}: {len(asr_result)} 条字幕，剧本 {len(script)} 字，对齐耗时 {seconds * 1000:.1f} ms")
+    print(f"  识别原文 vs LLM: 完全一致 {asr_exact:.1%}，字符相似度 {asr_similarity:.1%}")
+    print(f"  本地对齐 vs LLM: 完全一致 {exact:.1%}，字符相似度 {similarity:.1%}，时间戳{'未改动' if timing_kept else '被改动'}")
+    print(f"  置信度低于 {min_confidence} 需交给 LLM 的片段: {low} 条")
+
+def perturb(text, rng, error_rate):
+    """模拟识别错误：按 error_rate 随机替换、漏掉或多出汉字"""
+    out = []
+    for char in text:
+        roll = rng.random()
+        if roll < error_rate * 0.6:
+            out.append(chr(rng.randint(0x4E00, 0x4E00 + 3000)))
+        elif roll < error_rate * 0.85:
+            continue
+        elif roll < error_rate:
+            out.append(char)
+            out.append(chr(rng.randint(0x4E00, 0x4E00 + 3000)))
+        else:
+            out.append(char)
+    return "".join(out) or text[:1]
+
+def make_synthetic(chars, error_rate, seed=0):
+    """生成约 chars 字的剧本，按逗号/句号分句作为真实字幕，识别结果去掉标点并加入错误"""
+    rng = random.Random(seed)
+    charset = [chr(code) for code in range(0x4E00, 0x4E00 + 3000)]
+    script_parts = []
+    length = 0
+    while length < chars:
+        clause = "".join(rng.choice(charset) for _ in range(rng.randint(4, 18)))
+        punct = rng.choice("，，，。！？")
+        script_parts.append(clause + punct + ("\n" if punct != "，" and rng.random() < 0.3 else ""))
+        length += len(clause) + 1
+    script = "".join(script_parts)
+    truth = [re.sub(r"\s+", "", part) for part in script_parts]
+    asr_result = []
+    t = 0.0
+    for part in truth:
+        duration = round(0.22 * len(part) + 0.2, 2)
+        asr_result.append({"text": perturb(clean_zh_text(part), rng, error_rate), "start": round(t, 2), "end": round(t + duration, 2), "duration": duration})
+        t += duration + 0.3
+    return script, asr_result, truth
+
+def bench_synthetic(sizes, error_rate, band):
+    for chars in sizes:
+        script, asr_result, truth = make_synthetic(chars, error_rate, seed=chars)
+        t0 = time.perf_counter()
+        aligned, _ = align_to_script(asr_result, script, band)
+        seconds = time.perf_counter() - t0
+        exact, similarity = score([item["text"] for item in aligned], truth)
+        # ru_maxrss 在 Linux 上以 KB 为单位，为进程至今的峰值
+        peak_mb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+        print(
+            f"合成剧本 {len(script):>6} 字 / {len(asr_result):>5} 条字幕（错误率 {error_rate:.0%}）: "
+            f"{seconds * 1000:8.1f} ms，{len(script) / seconds:>9.0f} 字/秒，完全一致 {exact:.1%}，字符相似度 {similarity:.1%}，"
+            f"内存峰值 {peak_mb:.0f} MB"
+        )
+
+def main():
+    parser = argparse.ArgumentParser(description="本地对齐器准确率与吞吐基准")
+    parser.add_argument("--fixture", nargs="*", default=[FIXTURE_DIR], help="含 story.txt、asr_result.json、subtitles.json 的目录")
+    parser.add_argument("--sizes", type=int, nargs="*", default=[5000, 20000, 50000, 100000], help="合成剧本的字数")
+    parser.add_argument("--band", type=int, default=ALIGN_BAND, help="锚点之间大间隙的带状 DP 带宽")
+    parser.add_argument("--error-rate", type=float, default=0.08)
+    parser.add_argument("--min-confidence", type=float, default=0.6)
+    args = parser.parse_args()
+
+    print(f"锚点间隙带宽: {args.band}")
+    for fixture_dir in args.fixture:
+        bench_fixture(fixture_dir, args.min_confidence, args.band)
+    bench_synthetic(args.sizes, args.error_rate, args.band)
+
+if __name__ == "__main__":
+    main()
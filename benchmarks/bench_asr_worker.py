@@ -0,0 +1,84 @@
+"""
+ASR 冷启动与常驻服务的单个故事延迟对比：
+    冷启动：每个故事在新进程中导入 Whisper、加载模型再转写（原来每次运行 extract_subtitles 的开销）
+    常驻：启动一次 asr_worker.serve 预加载模型，之后每个故事只通过本地 socket 提交转写请求
+模型与设备取自 config.yaml 的 model.asr（CPU 测试时可设 whisper: "tiny", device: "cpu"）
+
+用法（在项目根目录运行）：
+    python benchmarks/bench_asr_worker.py AUDIO_PATH [--stories 3]
+"""
+import os
+import sys
+import time
+import socket
+import argparse
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import yaml
+from asr_worker import serve, transcribe, request_transcription, load_worker_authkey
+
+def free_port(host):
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
+        sock.bind((host, 0))
+        return sock.getsockname()[1]
+
+def cold_story(audio_path, model_name, device):
+    """新进程（spawn）中加载模型并转写一次，计时包含进程启动与导入"""
+    t0 = time.perf_counter()
+    with ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context("spawn")) as executor:
+        segments = executor.submit(transcribe, audio_path, model_name, device).result()
+    return time.perf_counter() - t0, len(segments)
+
+def warm_story(host, port, authkey, audio_path, model_name, timeout=600):
+    """向常驻服务提交一次转写；服务仍在加载模型（尚未监听）时等待后重试，只计最后一次成功请求的耗时"""
+    deadline = time.monotonic() + timeout
+    while True:
+        t0 = time.perf_counter()
+        segments = request_transcription(host, port, authkey, audio_path, model_name)
+        if segments is not None:
+            return time.perf_counter() - t0, len(segments)
+        if time.monotonic() > deadline:
+            raise TimeoutError("ASR 服务未能在超时前启动")
+        time.sleep(0.5)
+
+def main():
+    parser = argparse.ArgumentParser(description="ASR 冷启动与常驻服务延迟对比")
+    parser.add_argument("audio_path")
+    parser.add_argument("--config", default="config/config.yaml")
+    parser.add_argument("--stories", type=int, default=3, help="每种方式处理的故事数（重复转写同一音频）")
+    args = parser.parse_args()
+
+    config = yaml.load(open(args.config, "r", encoding="utf-8"), Loader=yaml.FullLoader)
+    asr_config = config["model"]["asr"]
+    model_name, device, host = asr_config["whisper"], asr_config["device"], asr_config["worker_host"]
+    print(f"模型: {model_name}，设备: {device or '自动'}，音频: {args.audio_path}")
+
+    cold = []
+    for i in range(args.stories):
+        seconds, count = cold_story(args.audio_path, model_name, device)
+        cold.append(seconds)
+        print(f"冷启动 故事 {i + 1}: {seconds:.2f} 秒（{count} 个片段）")
+
+    port = free_port(host)
+    authkey = load_worker_authkey(config["base"]["cache_dir"])
+    server = multiprocessing.get_context("spawn").Process(target=serve, args=(host, port, authkey, model_name, device), daemon=True)
+    t0 = time.perf_counter()
+    server.start()
+    try:
+        warm = []
+        for i in range(args.stories):
+            seconds, count = warm_story(host, port, authkey, args.audio_path, model_name)
+            if i == 0:
+                print(f"常驻服务启动（含模型加载）: {time.perf_counter() - t0 - seconds:.2f} 秒，只需一次")
+            warm.append(seconds)
+            print(f"常驻服务 故事 {i + 1}: {seconds:.2f} 秒（{count} 个片段）")
+    finally:
+        server.terminate()
+        server.join()
+
+    cold_avg, warm_avg = sum(cold) / len(cold), sum(warm) / len(warm)
+    print(f"平均每个故事: 冷启动 {cold_avg:.2f} 秒，常驻服务 {warm_avg:.2f} 秒，加速 {cold_avg / warm_avg:.1f}x")
+
+if __name__ == "__main__":
+    main()
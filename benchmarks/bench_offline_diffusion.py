@@ -0,0 +1,58 @@
+"""
+离线文生图的批量基准：在 CPU 上用 tiny-sd 分别以 batch size 1 和 N 调用 generate_images_by_offline，
+输出每张图片的平均耗时，并检查相同种子在不同 batch size 下生成的图片一致
+
+用法（在项目根目录运行）：
+    python benchmarks/bench_offline_diffusion.py [--images 8] [--batch-size 4] [--tolerance 2]
+"""
+import os
+import sys
+import time
+import argparse
+import tempfile
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import numpy as np
+from PIL import Image # type: ignore
+from gen_image import get_pipeline, generate_images_by_offline, iter_batches
+
+MODEL = "tiny-sd"
+
+def run(pipe, prompts, seeds, batch_size, out_dir):
+    """按 batch_size 分批生成全部图片，返回 (总耗时, 图片路径列表)"""
+    os.makedirs(out_dir, exist_ok=True)
+    save_paths = [os.path.join(out_dir, f"scene_{i:02d}.png") for i in range(len(prompts))]
+    t0 = time.perf_counter()
+    for batch in iter_batches(range(len(prompts)), batch_size):
+        generate_images_by_offline(MODEL, pipe, [prompts[i] for i in batch], [save_paths[i] for i in batch], [seeds[i] for i in batch])
+    return time.perf_counter() - t0, save_paths
+
+def main():
+    parser = argparse.ArgumentParser(description="离线文生图 batch size 1 与 N 的耗时与一致性对比")
+    parser.add_argument("--images", type=int, default=8, help="每种 batch size 生成的图片数")
+    parser.add_argument("--batch-size", type=int, default=4, help="批量生成时的 batch size（N）")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--tolerance", type=int, default=2, help="允许的最大像素差（批量矩阵运算的浮点误差）")
+    args = parser.parse_args()
+
+    prompts = [f"a watercolor illustration of scene {i}, mountains and a river" for i in range(args.images)]
+    seeds = [args.seed + i for i in range(args.images)]
+    pipe = get_pipeline(MODEL, "cpu", "float32")
+    pipe.set_progress_bar_config(disable=True)
+    # 预热一次，排除首次调用的初始化开销
+    with tempfile.TemporaryDirectory(prefix="bench_offline_diffusion_") as work_dir:
+        run(pipe, prompts[:1], seeds[:1], 1, os.path.join(work_dir, "warmup"))
+
+        results = {}
+        for batch_size in [1, args.batch_size]:
+            seconds, paths = run(pipe, prompts, seeds, batch_size, os.path.join(work_dir, f"batch_{batch_size}"))
+            results[batch_size] = [np.asarray(Image.open(path), dtype=np.int16) for path in paths]
+            print(f"batch size {batch_size:>3}: {args.images} 张图片 {seconds:7.2f} 秒，{seconds / args.images:.3f} 秒/张")
+
+    max_diff = max(int(np.abs(a - b).max()) for a, b in zip(results[1], results[args.batch_size]))
+    consistent = max_diff <= args.tolerance
+    print(f"相同种子在 batch size 1 与 {args.batch_size} 下的最大像素差: {max_diff}，{'一致' if consistent else '不一致'}")
+    if not consistent:
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
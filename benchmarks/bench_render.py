@@ -0,0 +1,98 @@
+"""
+渲染基准：生成合成时间线（场景图片、字幕、静音音轨），分别用单进程（render_workers=1）
+和多进程分块（render_workers=N）的 event 后端渲染，输出两者的耗时；加 --moviepy 时同时测试原来的 moviepy 逐帧合成
+
+用法（在项目根目录运行）：
+    python benchmarks/bench_render.py [--scenes 40] [--scene-seconds 6] [--workers 0] [--moviepy]
+"""
+import os
+import sys
+import time
+import wave
+import random
+import argparse
+import tempfile
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import numpy as np
+import yaml
+from PIL import Image # type: ignore
+from gen_video import render_with_events, render_with_moviepy, collect_scene_images, get_frame_size
+from utils.image_cache import prepare_scene_images
+
+def make_timeline(work_dir, scenes, scene_seconds, seed=0):
+    """在 work_dir 下生成 scene_XX.png（1024x1536）、静音 WAV 音轨，返回 (scene_timestamps, subtitles, 图片目录, 音频路径)"""
+    rng = random.Random(seed)
+    image_dir = os.path.join(work_dir, "images")
+    os.makedirs(image_dir, exist_ok=True)
+    gradient = np.linspace(0, 255, 1536, dtype=np.float32)[:, None]
+    scene_timestamps = []
+    t = 0.0
+    for i in range(scenes):
+        color = np.array([rng.randint(0, 255) for _ in range(3)], dtype=np.float32)
+        pixels = np.broadcast_to(gradient[:, :, None] * 0.5 + color * 0.5, (1536, 1024, 3))
+        Image.fromarray(pixels.astype(np.uint8)).save(os.path.join(image_dir, f"scene_{i:02d}.png"))
+        duration = round(scene_seconds * rng.uniform(0.5, 1.5), 2)
+        scene_timestamps.append({"scene_number": i, "start": round(t, 2), "end": round(t + duration, 2), "duration": duration})
+        t += duration
+
+    # 字幕首尾相接，每条 1.5-4 秒，部分字幕跨越场景（与分块）边界
+    charset = [chr(code) for code in range(0x4E00, 0x4E00 + 2000)]
+    subtitles = []
+    start = 0.0
+    while start < t:
+        end = min(t, start + rng.uniform(1.5, 4.0))
+        text = "".join(rng.choice(charset) for _ in range(rng.randint(8, 30)))
+        subtitles.append({"text": text, "start": round(start, 2), "end": round(end, 2), "duration": round(end - start, 2)})
+        start = end
+
+    audio_path = os.path.join(work_dir, "audio.wav")
+    sample_rate = 16000
+    with wave.open(audio_path, "wb") as f:
+        f.setnchannels(1)
+        f.setsampwidth(2)
+        f.setframerate(sample_rate)
+        f.writeframes(np.zeros(int(t * sample_rate), dtype=np.int16).tobytes())
+    return scene_timestamps, subtitles, image_dir, audio_path
+
+def main():
+    parser = argparse.ArgumentParser(description="单进程与多进程分块渲染耗时对比")
+    parser.add_argument("--config", default="config/config.yaml")
+    parser.add_argument("--scenes", type=int, default=40)
+    parser.add_argument("--scene-seconds", type=float, default=6.0)
+    parser.add_argument("--workers", type=int, default=0, help="多进程渲染的进程数，0 表示全部 CPU 核")
+    parser.add_argument("--moviepy", action="store_true", help="同时测试 moviepy 逐帧合成")
+    args = parser.parse_args()
+
+    config = yaml.load(open(args.config, "r", encoding="utf-8"), Loader=yaml.FullLoader)
+    font_path = os.path.join(config["base"]["resources_dir"], "font", config["files"]["resources"]["font"])
+    bg_mode = config["function"]["bg_mode"]
+    workers = args.workers or os.cpu_count() or 1
+
+    with tempfile.TemporaryDirectory(prefix="bench_render_") as work_dir:
+        scene_timestamps, subtitles, image_dir, audio_path = make_timeline(work_dir, args.scenes, args.scene_seconds)
+        total = scene_timestamps[-1]["end"]
+        print(f"合成时间线: {args.scenes} 个场景，{len(subtitles)} 条字幕，时长 {total:.1f} 秒")
+
+        # 预先生成场景图片缓存，各次渲染只比较合成与编码
+        image_cache_dir = os.path.join(work_dir, "scene_images")
+        scene_images = collect_scene_images(scene_timestamps, image_dir)
+        prepare_scene_images([img_path for img_path, _ in scene_images], get_frame_size(scene_images[0][0]), image_cache_dir)
+
+        results = []
+        if args.moviepy:
+            output = os.path.join(work_dir, "moviepy.mp4")
+            t0 = time.perf_counter()
+            render_with_moviepy(scene_timestamps, subtitles, image_dir, audio_path, output, font_path, bg_mode, image_cache_dir)
+            results.append(("moviepy 逐帧合成", time.perf_counter() - t0))
+        for label, render_workers in [("event render_workers=1", 1), (f"event render_workers={workers}", workers)]:
+            output = os.path.join(work_dir, f"event_{render_workers}.mp4")
+            t0 = time.perf_counter()
+            render_with_events(scene_timestamps, subtitles, image_dir, audio_path, output, font_path, bg_mode, image_cache_dir, render_workers)
+            results.append((label, time.perf_counter() - t0))
+
+    baseline = results[-2][1]
+    for label, seconds in results:
+        print(f"{label:<28} {seconds:8.2f} 秒（视频时长的 {seconds / total:.2f} 倍，相对单进程 {baseline / seconds:.2f}x）")
+
+if __name__ == "__main__":
+    main()
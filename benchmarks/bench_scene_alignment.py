@@ -0,0 +1,190 @@
+"""
+字幕-场景对齐的规模基准：在 1k/5k/10k 个场景的合成故事上分别运行原来的嵌套扫描版
+add_time_to_split_story 与当前的游标版，检查两者的返回值和写出的两个 JSON 文件完全一致，并输出耗时
+
+用法（在项目根目录运行）：
+    python benchmarks/bench_scene_alignment.py [--sizes 1000 5000 10000]
+"""
+import os
+import sys
+import copy
+import json
+import time
+import random
+import argparse
+import tempfile
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from gen_video import add_time_to_split_story
+from utils.tools import clean_zh_text
+
+def legacy_add_time_to_split_story(subtitles, split_story, subtitles_matched_scenes_path, split_story_matched_subs_path, audio_duration=None):
+    """优化前的实现：字幕 × 场景嵌套扫描，内层循环中反复清洗场景文本"""
+    for scene in split_story:
+        scene["consumed"] = False
+        scene["start"] = None
+        scene["end"] = None
+        scene["duration"] = 0.0
+        scene["matched_subs"] = []
+
+    sub_matched = False
+    for i, sub in enumerate(subtitles):
+        sub_text = clean_zh_text(sub["text"])
+        sub["matched_scenes"] = []
+        for scene in split_story:
+            if scene["consumed"]:
+                continue
+            scene_text = clean_zh_text(scene["text"])
+            if len(sub_text) <= len(scene_text):
+                if sub_text in scene_text:
+                    sub["matched_scenes"].append(scene["scene_number"])
+                    scene["matched_subs"].append(i)
+                    sub_matched = True
+                    break
+                else:
+                    scene["consumed"] = True
+                    continue
+            else:
+                if sub_matched:
+                    scene["consumed"] = True
+                    sub_matched = False
+                    continue
+                if scene_text in sub_text:
+                    sub["matched_scenes"].append(scene["scene_number"])
+                    scene["matched_subs"].append(i)
+                    scene["consumed"] = True
+                else:
+                    break
+
+    if audio_duration is None:
+        audio_duration = max((sub["end"] for sub in subtitles if "end" in sub), default=0.0)
+
+    for scene in split_story:
+        matched_subs = scene.get("matched_subs", [])
+        if not matched_subs:
+            continue
+        subs = [subtitles[i] for i in matched_subs]
+        if all(len(sub.get("matched_scenes", [])) == 1 for sub in subs):
+            start = min(sub["start"] for sub in subs)
+            end = max(sub["end"] for sub in subs)
+            scene["start"] = round(start, 2)
+            scene["end"] = round(end, 2)
+            scene["duration"] = round(end - start, 2)
+        else:
+            for sub in subs:
+                matched = sub.get("matched_scenes", [])
+                if len(matched) <= 1:
+                    continue
+                total_duration = sub["end"] - sub["start"]
+                per_duration = total_duration / len(matched)
+                for j, scn_num in enumerate(matched):
+                    scn = next((s for s in split_story if s["scene_number"] == scn_num), None)
+                    if scn:
+                        scn_start = sub["start"] + j * per_duration
+                        scn_end = sub["start"] + (j + 1) * per_duration if j < len(matched) - 1 else sub["end"]
+                        scn["start"] = round(scn_start, 2)
+                        scn["end"] = round(scn_end, 2)
+                        scn["duration"] = round(scn["end"] - scn["start"], 2)
+
+    if split_story and split_story[0].get("start") is not None and split_story[0]["start"] > 0:
+        split_story[0]["start"] = 0.0
+        split_story[0]["duration"] = round(split_story[0]["end"] - 0.0, 2)
+
+    for i in range(1, len(split_story)):
+        prev = split_story[i - 1]
+        curr = split_story[i]
+        if prev.get("end") is not None and curr.get("start") is not None and curr["start"] > prev["end"]:
+            prev_duration = prev["end"] - prev.get("start", 0)
+            curr_duration = curr["end"] - curr.get("start", 0)
+            if prev_duration < curr_duration:
+                prev["end"] = curr["start"]
+                prev["duration"] = round(prev["end"] - prev["start"], 2)
+            else:
+                curr["start"] = prev["end"]
+                curr["duration"] = round(curr["end"] - curr["start"], 2)
+
+    if split_story and split_story[-1].get("end") is not None and split_story[-1]["end"] < audio_duration:
+        split_story[-1]["end"] = round(audio_duration, 2)
+        split_story[-1]["duration"] = round(audio_duration - split_story[-1]["start"], 2)
+
+    with open(subtitles_matched_scenes_path, "w", encoding="utf-8") as f:
+        json.dump(subtitles, f, ensure_ascii=False, indent=2)
+    with open(split_story_matched_subs_path, "w", encoding="utf-8") as f:
+        json.dump(split_story, f, ensure_ascii=False, indent=2)
+    return subtitles, split_story
+
+def make_story(scenes, seed=0):
+    """
+    生成 scenes 个场景的合成故事及其字幕：场景按逗号拆成多条字幕，
+    连续的短场景有一半概率合并进同一条字幕（一个字幕对应多张图片），字幕带有与剧本不同的标点
+    """
+    rng = random.Random(seed)
+    charset = [chr(code) for code in range(0x4E00, 0x4E00 + 3000)]
+    split_story = []
+    for i in range(scenes):
+        if rng.random() < 0.3:
+            # 约三成为一句话的短场景
+            sentences = ["".join(rng.choice(charset) for _ in range(rng.randint(3, 8)))]
+        else:
+            sentences = ["".join(rng.choice(charset) for _ in range(rng.randint(4, 20))) for _ in range(rng.randint(1, 4))]
+        split_story.append({"scene_number": i, "text": "，".join(sentences) + "。"})
+
+    subtitles = []
+    t = 0.0
+
+    def add_subtitle(text):
+        nonlocal t
+        duration = round(0.2 * len(text) + rng.uniform(0.2, 0.8), 2)
+        subtitles.append({"text": text, "start": round(t, 2), "end": round(t + duration, 2), "duration": duration})
+        t += duration + rng.choice([0.0, 0.0, 0.1, 0.3])
+
+    i = 0
+    while i < scenes:
+        text = split_story[i]["text"]
+        count = 1
+        while i + count < scenes and count < 3 and len(split_story[i + count - 1]["text"]) < 12 and len(split_story[i + count]["text"]) < 12:
+            count += 1
+        merged = " ".join(scene["text"].rstrip("。") for scene in split_story[i:i + count])
+        # 对齐算法按长度判断包含方向：合并的字幕需长于前后相邻的场景，否则前一个场景的残句判断或
+        # 匹配后的继续扫描会错误地消耗场景，只生成能被正确匹配的合并字幕
+        neighbors = split_story[max(i - 1, 0):i] + split_story[i + count:i + count + 1]
+        if count > 1 and rng.random() < 0.5 and all(len(clean_zh_text(merged)) > len(clean_zh_text(scene["text"])) for scene in neighbors):
+            # 连续的短场景合并为一条字幕
+            add_subtitle(merged)
+            i += count
+            continue
+        for part in text.rstrip("。").split("，"):
+            add_subtitle(part)
+        i += 1
+    return subtitles, split_story, t
+
+def run(func, subtitles, split_story, audio_duration, work_dir, name):
+    subs_path = os.path.join(work_dir, f"{name}_subtitles_matched_scenes.json")
+    story_path = os.path.join(work_dir, f"{name}_split_story_matched_subs.json")
+    subtitles, split_story = copy.deepcopy(subtitles), copy.deepcopy(split_story)
+    t0 = time.perf_counter()
+    result = func(subtitles, split_story, subs_path, story_path, audio_duration)
+    seconds = time.perf_counter() - t0
+    with open(subs_path, "rb") as f1, open(story_path, "rb") as f2:
+        files = (f1.read(), f2.read())
+    return result, files, seconds
+
+def main():
+    parser = argparse.ArgumentParser(description="add_time_to_split_story 规模基准")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1000, 5000, 10000])
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory(prefix="bench_scene_alignment_") as work_dir:
+        for scenes in args.sizes:
+            subtitles, split_story, audio_duration = make_story(scenes, seed=scenes)
+            legacy_result, legacy_files, legacy_seconds = run(legacy_add_time_to_split_story, subtitles, split_story, audio_duration, work_dir, "legacy")
+            result, files, seconds = run(add_time_to_split_story, subtitles, split_story, audio_duration, work_dir, "current")
+            identical = result == legacy_result and files == legacy_files
+            print(
+                f"{scenes:>6} 个场景 / {len(subtitles):>6} 条字幕: 原实现 {legacy_seconds:8.3f} 秒，当前 {seconds:8.3f} 秒，"
+                f"加速 {legacy_seconds / seconds:6.1f}x，输出{'一致' if identical else '不一致'}"
+            )
+            if not identical:
+                sys.exit(1)
+
+if __name__ == "__main__":
+    main()
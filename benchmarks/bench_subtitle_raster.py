@@ -0,0 +1,124 @@
+"""
+字幕绘制微基准：1,000 条字幕的剧本，对比旧版（每条字幕重新加载字体、textlength(line + char) 逐字重测整行换行）
+与 render_subtitle_image（字体与字宽缓存、线性换行、位图按文本缓存）的耗时，并检查两者输出的位图是否一致
+
+用法（在项目根目录运行）：
+    python benchmarks/bench_subtitle_raster.py [--subtitles 1000] [--repeat-ratio 0.2]
+"""
+import os
+import sys
+import time
+import random
+import argparse
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import numpy as np
+import yaml
+from PIL import Image, ImageDraw, ImageFont # type: ignore
+from gen_video import render_subtitle_image, load_font, glyph_width, VIDEO_HEIGHT
+
+def legacy_render_subtitle_image(text, img_size, font_path, bg_mode="dynamic"):
+    """优化前 create_subtitle_clip 中的绘制部分（不含 ImageClip 封装）"""
+    width, height = img_size
+    font_size = 30
+    font = ImageFont.truetype(font_path, font_size)
+
+    max_text_width = int(width * 0.9)
+    draw_dummy = ImageDraw.Draw(Image.new("RGB", (1, 1)))
+
+    def wrap_text(text, font, max_width):
+        lines = []
+        line = ""
+        for char in text:
+            if draw_dummy.textlength(line + char, font=font) <= max_width:
+                line += char
+            else:
+                lines.append(line)
+                line = char
+        lines.append(line)
+        return lines
+
+    lines = wrap_text(text, font, max_text_width)
+    line_height = font_size + 10
+    total_text_height = len(lines) * line_height
+    max_line_width = max(draw_dummy.textlength(line, font=font) for line in lines)
+
+    padding = 20
+    bg_width = int(max_line_width + 2 * padding)
+    bg_height = int(total_text_height + 2 * padding)
+
+    canvas = Image.new("RGBA", (bg_width, bg_height), (0, 0, 0, 0))
+    draw = ImageDraw.Draw(canvas)
+    if bg_mode == "dynamic":
+        draw.rectangle([(0, 0), (bg_width, bg_height)], fill=(0, 0, 0, 150))
+
+    y = padding
+    for line in lines:
+        line_width = draw.textlength(line, font=font)
+        x = (bg_width - line_width) // 2
+        draw.text((x, y), line, font=font, fill="white")
+        y += line_height
+    return np.array(canvas)
+
+def make_subtitles(count, repeat_ratio, seed=0):
+    """生成 count 条 8-60 字的中文字幕，其中约 repeat_ratio 比例重复之前出现过的文本"""
+    rng = random.Random(seed)
+    # 常用汉字区间加少量标点，接近真实字幕的字宽分布
+    charset = [chr(code) for code in range(0x4E00, 0x4E00 + 2000)] + list("，。！？“”")
+    subtitles = []
+    for _ in range(count):
+        if subtitles and rng.random() < repeat_ratio:
+            subtitles.append(rng.choice(subtitles))
+        else:
+            subtitles.append("".join(rng.choice(charset) for _ in range(rng.randint(8, 60))))
+    return subtitles
+
+def main():
+    parser = argparse.ArgumentParser(description="字幕绘制微基准")
+    parser.add_argument("--config", default="config/config.yaml")
+    parser.add_argument("--subtitles", type=int, default=1000)
+    parser.add_argument("--repeat-ratio", type=float, default=0.2)
+    parser.add_argument("--width", type=int, default=480, help="画面宽度（高度固定为 VIDEO_HEIGHT）")
+    args = parser.parse_args()
+
+    config = yaml.load(open(args.config, "r", encoding="utf-8"), Loader=yaml.FullLoader)
+    font_path = os.path.join(config["base"]["resources_dir"], "font", config["files"]["resources"]["font"])
+    bg_mode = config["function"]["bg_mode"]
+    img_size = (args.width, VIDEO_HEIGHT)
+    subtitles = make_subtitles(args.subtitles, args.repeat_ratio)
+
+    t0 = time.perf_counter()
+    legacy = [legacy_render_subtitle_image(text, img_size, font_path, bg_mode) for text in subtitles]
+    legacy_seconds = time.perf_counter() - t0
+
+    load_font.cache_clear()
+    glyph_width.cache_clear()
+    render_subtitle_image.cache_clear()
+    t0 = time.perf_counter()
+    current = [render_subtitle_image(text, img_size, font_path, bg_mode) for text in subtitles]
+    cold_seconds = time.perf_counter() - t0
+    cold_info = render_subtitle_image.cache_info()
+
+    # 同一批字幕按顺序再渲染一次（如 moviepy 后端逐帧查询字幕）；位图缓存容量有限（maxsize），
+    # 不同文本多于容量时按顺序重放会不断淘汰，命中率以 cache_info() 的实际统计为准
+    t0 = time.perf_counter()
+    for text in subtitles:
+        render_subtitle_image(text, img_size, font_path, bg_mode)
+    replay_seconds = time.perf_counter() - t0
+    replay_info = render_subtitle_image.cache_info()
+    replay_hits = replay_info.hits - cold_info.hits
+
+    identical = sum(np.array_equal(a, b) for a, b in zip(legacy, current))
+    print(f"字幕数: {len(subtitles)}（不同文本 {len(set(subtitles))} 条），画面 {img_size[0]}x{img_size[1]}")
+    print(f"旧版逐条加载字体 + 平方级换行: {legacy_seconds:.3f} 秒（{legacy_seconds / len(subtitles) * 1000:.2f} ms/条）")
+    print(
+        f"render_subtitle_image 首次:     {cold_seconds:.3f} 秒（{cold_seconds / len(subtitles) * 1000:.2f} ms/条），加速 {legacy_seconds / cold_seconds:.1f}x，"
+        f"位图缓存命中 {cold_info.hits}/{len(subtitles)}"
+    )
+    print(
+        f"render_subtitle_image 再次渲染: {replay_seconds:.3f} 秒，位图缓存命中 {replay_hits}/{len(subtitles)}"
+        f"（{replay_hits / len(subtitles):.0%}，缓存容量 {replay_info.maxsize}）"
+    )
+    print(f"输出位图一致: {identical}/{len(subtitles)}")
+
+if __name__ == "__main__":
+    main()
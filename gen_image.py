@@ -1,17 +1,26 @@
 import imp
+import gc
 import json
 import os
+import time
 import logging
 import base64
+from concurrent.futures import ThreadPoolExecutor
 from openai import OpenAI
 import torch
 from diffusers.pipelines.stable_diffusion.pipeline_stable_diffusion import StableDiffusionPipeline
 from transformers import logging as hf_logging
+from utils.batch_executor import BatchExecutor
 
 hf_logging.set_verbosity_error()
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 
-def generate_images(config):
+def generate_images(config, scenes=None):
+    """
+    为每个场景生成图片 scene_XX.png
+    scenes 为 None 时读取 scene_prompts.json；也可以传入逐个产出场景的迭代器（如 iter_story_scene_prompts），
+    此时每收到一个场景立即生成；已存在的图片均跳过
+    """
     use_api = config["model"]["img"]["use_api"]
     img_dir = os.path.join(config["base"]["base_dir"], config["files"]["media"]["image_dir"])
     os.makedirs(img_dir, exist_ok=True)
@@ -29,48 +38,78 @@ def generate_images(config):
                 return False
         return True
 
-    scenes = json.loads(open(scene_prompts_path, "r", encoding="utf-8").read())
-    if check_image_exists(scenes, img_dir):
-        logging.info("场景图片已存在，跳过生成")
-        return
+    if scenes is None:
+        scenes = json.loads(open(scene_prompts_path, "r", encoding="utf-8").read())
+        if check_image_exists(scenes, img_dir):
+            logging.info("场景图片已存在，跳过生成")
+            return
+    # 只生成缺失的图片
+    scenes = (scene for scene in scenes if not os.path.exists(os.path.join(img_dir, f"scene_{scene['scene_number']:02d}.png")))
     
     logging.info("开始生成场景图片...")
 
     if not use_api:
         img_model = config["model"]["img"]["offline"]
-        pipe = load_model(img_model)
-        for scene in scenes:
-            scene_num = scene["scene_number"]
-            prompt = scene["prompt"]
-            save_path = os.path.join(img_dir, f"scene_{scene_num:02d}.png")
+        batch_size = config["model"]["img"]["offline_batch_size"]
+        seed = config["model"]["img"]["seed"]
+        img_config = config["model"]["img"]
+        pipe = get_pipeline(img_model, img_config["device"], img_config["dtype"], img_config["min_free_memory"])
+        # 每 batch_size 个场景合并为一次 pipeline 调用，每个场景用 seed + scene_number 作为随机种子，结果可复现
+        for batch in iter_batches(scenes, batch_size):
+            scene_nums = [scene["scene_number"] for scene in batch]
+            prompts = [scene["prompt"] for scene in batch]
+            save_paths = [os.path.join(img_dir, f"scene_{scene_num:02d}.png") for scene_num in scene_nums]
             try:
-                generate_image_by_offline(img_model, pipe, prompt, save_path)
-                logging.info(f"场景 {scene_num} 图片生成成功")
+                start = time.perf_counter()
+                generate_images_by_offline(img_model, pipe, prompts, save_paths, [seed + scene_num for scene_num in scene_nums])
+                elapsed = time.perf_counter() - start
+                logging.info(f"场景 {scene_nums} 图片生成成功，耗时 {elapsed:.1f} 秒（{elapsed / len(batch):.2f} 秒/张）")
             except Exception as e:
-                logging.error(f"生成场景 {scene_num} 图片时出错: {str(e)}")
+                logging.error(f"生成场景 {scene_nums} 图片时出错: {str(e)}")
                 break
     else:
-        img_client = OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
-        img_model = config["model"]["img"]["api"]
-        for scene in scenes:
+        img_config = config["model"]["img"]
+        img_client = OpenAI(api_key=os.getenv("OPENAI_API_KEY"), base_url=img_config["base_url"])
+        img_model = img_config["api"]
+        # 各场景并发请求，共用令牌桶限速，失败时指数退避重试；单个场景最终失败不影响其他场景
+        executor = BatchExecutor.from_config(img_config)
+
+        def generate(scene):
             scene_num = scene["scene_number"]
-            prompt = scene["prompt"]
             save_path = os.path.join(img_dir, f"scene_{scene_num:02d}.png")
-            try:
-                generate_image_by_api(prompt, save_path, img_client, img_model)
+
+            def request(batch):
+                generate_image_by_api(scene["prompt"], save_path, img_client, img_model)
                 logging.info(f"场景 {scene_num} 图片生成成功")
-            except Exception as e:
-                logging.error(f"生成场景 {scene_num} 图片时出错: {str(e)}")
-                break
+                return [scene_num]
+
+            def give_up(batch):
+                logging.error(f"生成场景 {scene_num} 图片时出错，已放弃")
+                return []
+
+            return scene_num, bool(executor.run([[scene]], request, give_up)[0])
+
+        with ThreadPoolExecutor(max_workers=executor.concurrency) as pool:
+            futures = [pool.submit(generate, scene) for scene in scenes]
+            failed = sorted(scene_num for scene_num, ok in (future.result() for future in futures) if not ok)
+        if failed:
+            logging.error(f"共 {len(failed)} 个场景图片生成失败: {failed}，重新运行时只会生成缺失的图片")
+        else:
+            logging.info(f"全部 {len(futures)} 个场景图片生成成功")
+
+    # 流式输入时出错中断后仍把剩余场景消费完，使提示词生成完成并写入 scene_prompts.json
+    for _ in scenes:
+        pass
 
 def generate_image_by_api(prompt, save_path, img_client, model="gpt-image-1"):
     """
     https://platform.openai.com/docs/api-reference/images/createVariation
     使用OpenAI的DALL·E 3 API根据提示词生成图片并保存到本地。
-    
+    以流式响应读取，边接收边把 base64 解码写入临时文件，不在内存中保存完整的 base64 字符串，
+    写完后再替换为目标文件，中途失败不会留下不完整的图片
     """
     if model == "gpt-image-1":
-        result = img_client.images.generate(
+        params = dict(
             model="gpt-image-1",
             prompt=prompt,
             n=1,
@@ -78,78 +117,193 @@ def generate_image_by_api(prompt, save_path, img_client, model="gpt-image-1"):
             quality="low"
         )
     elif model == "dall-e-3":
-        result = img_client.images.generate(
+        params = dict(
             model="dall-e-3",
             prompt=prompt,
             n=1,
-            size="1024x1792"
+            size="1024x1792",
+            response_format="b64_json"
         )
     elif model == "dall-e-2":
-        result = img_client.images.generate(
+        params = dict(
             model="dall-e-2",
             prompt=prompt,
             n=1,
-            size="1024x1024"
+            size="1024x1024",
+            response_format="b64_json"
         )
-    image_base64 = result.data[0].b64_json
-    image_bytes = base64.b64decode(image_base64)
+    else:
+        raise ValueError(f"不支持的模型: {model}")
+
+    tmp_path = f"{save_path}.part"
+    try:
+        with img_client.images.with_streaming_response.generate(**params) as response:
+            with open(tmp_path, "wb") as f:
+                write_b64_json_image(response.iter_bytes(), f)
+        os.replace(tmp_path, save_path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+B64_JSON_KEY = b'"b64_json"'
+
+def write_b64_json_image(chunks, f):
+    """
+    从逐段到达的 JSON 响应字节中找到第一个 b64_json 字段，把其中的 base64 按 4 字节对齐分段解码写入 f
+
+    Returns:
+        int: 写入的字节数
+    """
+    buffer = b""
+    state = "key"  # key: 寻找字段名；quote: 寻找字符串开头的引号；data: 读取 base64
+    written = 0
+    for chunk in chunks:
+        buffer += chunk
+        if state == "key":
+            idx = buffer.find(B64_JSON_KEY)
+            if idx == -1:
+                buffer = buffer[-(len(B64_JSON_KEY) - 1):]
+                continue
+            buffer = buffer[idx + len(B64_JSON_KEY):]
+            state = "quote"
+        if state == "quote":
+            idx = buffer.find(b'"')
+            if idx == -1:
+                buffer = b""
+                continue
+            buffer = buffer[idx + 1:]
+            state = "data"
+        end = buffer.find(b'"')
+        # base64 字符中没有反斜杠，去掉 JSON 转义（如 \/）即可
+        data = (buffer if end == -1 else buffer[:end]).replace(b"\\", b"")
+        usable = len(data) if end != -1 else len(data) - len(data) % 4
+        written += f.write(base64.b64decode(data[:usable]))
+        if end != -1:
+            return written
+        buffer = data[usable:]
+    raise ValueError("响应中没有完整的 b64_json 图片数据")
+
+def iter_batches(items, batch_size):
+    """把可迭代对象（可以是流式产出的场景）按 batch_size 分组，凑满一组立即产出"""
+    batch = []
+    for item in items:
+        batch.append(item)
+        if len(batch) == batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+_pipelines = {}
 
-    # Save the image to a file
-    with open(save_path, "wb") as f:
-        f.write(image_bytes)
+def select_device(device=None):
+    """device 为 None 时有 CUDA 用 CUDA，否则用 CPU"""
+    if device is None:
+        device = "cuda" if torch.cuda.is_available() else "cpu"
+    return device
 
-def load_model(model):
+def select_dtype(device, dtype=None):
+    """dtype 为 None 时 CUDA 上用 float16，CPU 上用 float32（CPU 上 float16 很慢且部分算子不支持）"""
+    if dtype is None:
+        return torch.float16 if device.startswith("cuda") else torch.float32
+    return getattr(torch, dtype) if isinstance(dtype, str) else dtype
+
+def get_pipeline(model, device=None, dtype=None, min_free_memory=0.0):
+    """
+    按 (模型, dtype, 设备) 缓存 pipeline：首次使用时加载，之后同一进程内的所有场景、所有故事共用同一个实例
+    加载新的 pipeline 前若 CUDA 空闲显存占比低于 min_free_memory，先释放其他已缓存的 pipeline
+    """
+    device = select_device(device)
+    dtype = select_dtype(device, dtype)
+    key = (model, dtype, device)
+    if key not in _pipelines:
+        if device.startswith("cuda") and min_free_memory > 0:
+            free, total = torch.cuda.mem_get_info()
+            if free / total < min_free_memory:
+                logging.info(f"空闲显存仅剩 {free / total:.0%}，释放其他已加载的模型")
+                release_pipelines()
+        logging.info(f"加载文生图模型 {model}（{dtype}, {device}）...")
+        _pipelines[key] = load_model(model, dtype, device)
+    return _pipelines[key]
+
+def release_pipelines(model=None):
+    """释放已缓存的 pipeline（model 为 None 时释放全部），并清理显存"""
+    for key in [key for key in _pipelines if model is None or key[0] == model]:
+        logging.info(f"释放文生图模型 {key[0]}（{key[1]}, {key[2]}）")
+        del _pipelines[key]
+    gc.collect()
+    if torch.cuda.is_available():
+        torch.cuda.empty_cache()
+
+def load_model(model, dtype, device):
     if model == "sd3.5":
         model_path_offline = "resources/models/img/stable-diffusion-3.5-medium"
         model_path_online = "stabilityai/stable-diffusion-3.5-medium"
         from diffusers.pipelines.stable_diffusion_3.pipeline_stable_diffusion_3 import StableDiffusion3Pipeline
-        import gc
 
         pipe = StableDiffusion3Pipeline.from_pretrained(
             model_path_offline, 
-            torch_dtype=torch.float16
-        ).to("cuda")
+            torch_dtype=dtype
+        )
 
-        pipe.enable_model_cpu_offload()  # 不活跃模块转 CPU
+        if device.startswith("cuda"):
+            pipe.enable_model_cpu_offload()  # 不活跃模块转 CPU
+        else:
+            pipe.to(device)
         pipe.enable_attention_slicing() 
         # pipe.enable_sequential_cpu_offload()  # 更进一步：模块顺序加载（比前者更激进）
 
     elif model == "taiyi-sd":
         model_path = "resources/models/img/taiyi-sd"
+        pipe = StableDiffusionPipeline.from_pretrained(
+            "IDEA-CCNL/Taiyi-Stable-Diffusion-1B-Chinese-v0.1",
+            torch_dtype=dtype,
+            use_safetensors = False
+        ).to(device)
+
+    elif model == "tiny-sd":
+        # 仅用于在 CPU 上测试与对比批量生成的吞吐，生成的图片没有实际内容
+        pipe = StableDiffusionPipeline.from_pretrained(
+            "hf-internal-testing/tiny-stable-diffusion-pipe",
+            torch_dtype=dtype,
+            safety_checker=None,
+        ).to(device)
+
+    else:
+        raise ValueError(f"不支持的模型: {model}")
     
     return pipe
 
-def generate_image_by_offline(model, pipe, prompt, save_path):
+def generate_images_by_offline(model, pipe, prompts, save_paths, seeds):
     '''
     访问受限模型需要登陆
     huggingface-cli login
+
+    一次 pipeline 调用生成一批图片，seeds 为每张图片的随机种子，与单张生成时相同种子的结果一致
     '''
+    generators = [torch.Generator("cpu").manual_seed(seed) for seed in seeds]
 
     if model == "taiyi-sd":
-        pipe = StableDiffusionPipeline.from_pretrained(
-            "IDEA-CCNL/Taiyi-Stable-Diffusion-1B-Chinese-v0.1",
-            torch_dtype=torch.float16,
-            use_safetensors = False
-        ).to("cuda")
-
-        prompt = prompt[:220]
-        image = pipe(prompt).images[0] # type: ignore
-        image.save(os.path.join(save_path))
+        prompts = [prompt[:220] for prompt in prompts]
+        images = pipe(prompts, generator=generators).images # type: ignore
 
     elif model == "sd3.5":
+        images = pipe(prompts, height=768, width=512, num_inference_steps=40, guidance_scale=4.5, generator=generators).images # type: ignore
 
-        import gc
+    elif model == "tiny-sd":
+        images = pipe(prompts, num_inference_steps=2, generator=generators).images # type: ignore
 
-        image = pipe(prompt, height=768, width=512, num_inference_steps=40, guidance_scale=4.5).images[0] # type: ignore
-        image.save(os.path.join(save_path))
+    else:
+        raise ValueError(f"不支持的模型: {model}")
+
+    for image, save_path in zip(images, save_paths):
+        image.save(save_path)
 
-        del image
+    if model == "sd3.5":
+        del images
         torch.cuda.empty_cache()
         gc.collect()
 
-    else:
-        raise ValueError(f"不支持的模型: {model}")
-
 if __name__ == "__main__":
     import yaml
     config = yaml.load(open("config/config.yaml", "r", encoding="utf-8"), Loader=yaml.FullLoader)
@@ -1,9 +1,17 @@
 import json
 import os
+import re
 import time
+import queue
+import threading
 from openai import OpenAI
 import logging
 from utils.prompt import get_prompt
+from utils.batch_executor import BatchExecutor, SplitBatch
+from utils.llm_cache import open_llm_cache, cached_completion, CompletionStream
+from utils.json_stream import iter_json_array, TruncatedJSONError
+from utils.tools import estimate_tokens, clean_zh_text
+from utils.aligner import split_points
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 
 def process_story_and_generate_prompts(config, client):
@@ -14,12 +22,25 @@ def process_story_and_generate_prompts(config, client):
         story_path: 故事文本文件路径
         output_path: 输出JSON文件路径
     """
+    output_path = os.path.join(config["base"]["base_dir"], config["files"]["text"]["scene_prompts"])
+    for _ in iter_story_scene_prompts(config, client):
+        pass
+    with open(output_path, "r", encoding="utf-8") as f:
+        result = f.read()
+    return result
+
+def iter_story_scene_prompts(config, client):
+    """
+    处理故事文本并逐个产出场景提示词 {scene_number, scene_detail, prompt}，
+    每个场景的提示词一生成完就产出，下游（如 generate_images）可与提示词生成重叠进行
+    """
     raw_output_path = os.path.join(config["base"]["base_dir"], config["files"]["text"]["raw_scene_prompts"])
     output_path = os.path.join(config["base"]["base_dir"], config["files"]["text"]["scene_prompts"])
     story_path = os.path.join(config["base"]["base_dir"], config["files"]["text"]["story"])
     split_story_path = os.path.join(config["base"]["base_dir"], config["files"]["text"]["split_story"])
 
-    generate_batch_size = config["model"]["llm"]["generate_batch_size"]
+    max_input_tokens = config["model"]["llm"]["generate_max_input_tokens"]
+    max_output_tokens = config["model"]["llm"]["generate_max_output_tokens"]
 
     # 读取故事
     with open(story_path, "r", encoding="utf-8") as f:
@@ -27,16 +48,28 @@ def process_story_and_generate_prompts(config, client):
     if len(story) == 0:
         raise ValueError("故事文本为空")
 
+    cache = open_llm_cache(config)
+
+    executor = BatchExecutor.from_config(config["model"]["llm"])
+
     # 分割故事
-    split_story = split_raw_story(client, story, split_story_path)
+    split_story = split_raw_story(
+        client, story, split_story_path, cache, executor,
+        config["model"]["llm"]["split_chunk_chars"], config["model"]["llm"]["split_overlap_chars"],
+    )
 
     # 生成提示词
-    result = generate_scene_prompts(client, split_story, output_path, generate_batch_size)
+    yield from stream_scene_prompts(client, split_story, output_path, max_input_tokens, max_output_tokens, executor, cache)
 
-    return result
+    if cache is not None:
+        cache.report("分割故事与生成提示词")
 
 
-def split_raw_story(client, story_text, split_story_path) -> str:
+def split_raw_story(client, story_text, split_story_path, cache=None, executor=None, chunk_chars=3000, overlap_chars=300) -> str:
+    """
+    分割故事：按段落把故事切成相互重叠的若干块并发交给 LLM 分段，再拼接回完整故事。
+    LLM 返回的分段只用于确定切分位置，场景文本一律取自原文，最后校验所有场景拼接后与原文完全一致
+    """
     if os.path.exists(split_story_path):
         logging.info(f"分割故事文件 {split_story_path} 已存在，跳过生成步骤")
         with open(split_story_path, "r", encoding="utf-8") as f:
@@ -44,21 +77,19 @@ def split_raw_story(client, story_text, split_story_path) -> str:
         return result
     logging.info("开始分割故事...")
     prompt = get_prompt("split_raw_story")
-    response = client.chat.completions.create(
-        model="deepseek-chat",
-        messages=[
-            {"role": "system", "content": prompt},
-            {"role": "user", "content": story_text}
-        ],
-        temperature=0.3,
-        stream=False,
+    executor = executor or BatchExecutor()
+
+    chunks = cut_story_chunks(story_text, chunk_chars, overlap_chars)
+    logging.info(f"故事共 {len(story_text)} 字，按段落切为 {len(chunks)} 块并发分段")
+    chunk_points = executor.run(
+        [[chunk] for chunk in chunks],
+        lambda batch: [request_story_split(client, prompt, story_text, batch[0], cache)],
     )
-    result = response.choices[0].message.content
-    if result is None:
-        raise ValueError("LLM 返回的内容为空")   
-    
+    cuts = stitch_chunk_cuts(chunks, [points for points, in chunk_points])
+
     # 将分割后的文本转换为JSON格式
-    segments = result.split("|")
+    segments = [story_text[start:end] for start, end in zip(cuts, cuts[1:])]
+    check_split_story(story_text, segments)
     segments = [seg.strip() for seg in segments if seg.strip()]
     
     json_data =[
@@ -74,50 +105,245 @@ def split_raw_story(client, story_text, split_story_path) -> str:
         f.write(result)
     return result
 
-def generate_scene_prompts(client, split_story, output_path, batch_size) -> str:
+def cut_story_chunks(story_text, chunk_chars, overlap_chars):
+    """
+    在段落边界处把故事切成若干块，每块不超过 chunk_chars 个字符（单个段落超长时自成一块），
+    相邻两块之间重叠不超过 overlap_chars 个字符的完整段落
+
+    Returns:
+        List[tuple]: 每块在原文中的 (起始下标, 结束下标)
+    """
+    paragraphs = [(m.start(), m.end()) for m in re.finditer(r"[^\n]*(?:\n|$)", story_text) if m.end() > m.start()]
+    if not paragraphs:
+        return [(0, len(story_text))]
+
+    chunks = []
+    first = last = 0
+    while True:
+        # 每块至少包含一个上一块没有的段落
+        last += 1
+        while last < len(paragraphs) and paragraphs[last][1] - paragraphs[first][0] <= chunk_chars:
+            last += 1
+        chunks.append((paragraphs[first][0], paragraphs[last - 1][1]))
+        if last == len(paragraphs):
+            return chunks
+        # 下一块从本块末尾若干个总长不超过 overlap_chars 的段落开始，重叠部分加上下一个段落不超过 chunk_chars
+        next_first = last
+        while (
+            next_first - 1 > first
+            and paragraphs[last - 1][1] - paragraphs[next_first - 1][0] <= overlap_chars
+            and paragraphs[last][1] - paragraphs[next_first - 1][0] <= chunk_chars
+        ):
+            next_first -= 1
+        first = next_first
+
+def request_story_split(client, prompt, story_text, chunk, cache=None):
+    """
+    让 LLM 在一块故事中插入分隔符，返回切分位置（原文下标，首尾为块的起止）
+    返回内容与原文差异过大时抛出异常，由 BatchExecutor 重试
+    """
+    start, end = chunk
+    chunk_text = story_text[start:end]
+
+    def parse(result):
+        segments = [seg for seg in result.split("|") if seg.strip()]
+        returned, expected = len(clean_zh_text("".join(segments))), len(clean_zh_text(chunk_text))
+        if not segments or abs(returned - expected) > max(10, expected * 0.1):
+            raise ValueError(f"分段结果与原文差异过大（原文 {expected} 字，返回 {returned} 字）")
+        return [start + point for point in split_points(segments, chunk_text)]
+
+    return cached_completion(
+        client, cache, "split_raw_story",
+        [
+            {"role": "system", "content": prompt},
+            {"role": "user", "content": chunk_text}
+        ],
+        temperature=0.3,
+        parse=parse,
+        stream=False,
+    )
+
+def stitch_chunk_cuts(chunks, chunk_points):
+    """
+    合并各块的切分位置：相邻两块在重叠区内取两块都认可、且最接近重叠区中点的切分位置作为交界，
+    没有共同切分位置时以后一块的起点（段落边界）为交界；交界之前用前一块的切分，之后用后一块的切分。
+    后一块可能在前两块的重叠区内就开始，交界只取上一个交界之后的位置，保证切分位置严格递增
+
+    Returns:
+        List[int]: 全文的切分位置，首尾为 0 和全文长度
+    """
+    cuts = [0]
+    boundary = 0
+    for k, points in enumerate(chunk_points):
+        if k + 1 < len(chunks):
+            overlap_start, overlap_end = chunks[k + 1][0], chunks[k][1]
+            next_points = set(chunk_points[k + 1][1:-1])
+            common = [p for p in points[1:-1] if max(overlap_start, boundary + 1) <= p < overlap_end and p in next_points]
+            middle = (overlap_start + overlap_end) / 2
+            next_boundary = min(common, key=lambda p: abs(p - middle)) if common else max(overlap_start, boundary)
+        else:
+            next_boundary = points[-1]
+        cuts.extend(p for p in points if boundary < p < next_boundary)
+        if next_boundary > boundary:
+            cuts.append(next_boundary)
+        boundary = next_boundary
+    return cuts
+
+def check_split_story(story_text, segments):
+    """校验分段后的场景按顺序拼接后与原文完全一致"""
+    joined = "".join(segments)
+    if joined != story_text:
+        mismatch = next((i for i, (a, b) in enumerate(zip(joined, story_text)) if a != b), min(len(joined), len(story_text)))
+        raise ValueError(f"分段后的场景拼接后与原文不一致（第 {mismatch} 个字符起）")
+
+def generate_scene_prompts(client, split_story, output_path, max_input_tokens, max_output_tokens, executor, cache=None) -> str:
+    for _ in stream_scene_prompts(client, split_story, output_path, max_input_tokens, max_output_tokens, executor, cache):
+        pass
+    with open(output_path, "r", encoding="utf-8") as f:
+        result = f.read()
+    return result
+
+def stream_scene_prompts(client, split_story, output_path, max_input_tokens, max_output_tokens, executor, cache=None):
+    """
+    逐个产出场景提示词（按生成完成的顺序），全部完成后按 scene_number 排序校验并写入 output_path
+    """
     if os.path.exists(output_path):
         logging.info(f"提示词文件 {output_path} 已存在，跳过生成步骤")
         with open(output_path, "r", encoding="utf-8") as f:
-            result = f.read()
-        return result
+            yield from json.load(f)
+        return
     logging.info("开始生成场景提示词...")
-    prompt = get_prompt("generate_scene_prompts")
 
-    # 将故事分成多个批次处理
     scenes = json.loads(split_story)
     results = []
+    for item in iter_scene_prompts(client, scenes, max_input_tokens, max_output_tokens, executor, cache):
+        results.append(item)
+        yield item
 
-    for i in range(0, len(scenes), batch_size):
-        batch = scenes[i:i + batch_size]
-        batch_story = json.dumps({"scenes": batch}, ensure_ascii=False, indent=2)
-
-        response = client.chat.completions.create(
-            model="deepseek-chat",
-            messages=[
-                {"role": "system", "content": prompt},
-                {"role": "user", "content": batch_story}
-            ],
-            temperature=0.7,
-            stream=False,
-        )
-        
-        batch_result = response.choices[0].message.content
-        if batch_result is None:
-            raise ValueError(f"第 {i//batch_size + 1} 批次 LLM 返回的内容为空")
-            
-        # 清理并解析批次结果
-        batch_result = batch_result.strip()
-            
-        try:
-
-            batch_data = json.loads(batch_result)
-            results.extend(batch_data)
-        except json.JSONDecodeError as e:
-            raise ValueError(f"第 {i//batch_size + 1} 批次返回的不是有效的JSON格式: {str(e)}")
-
-    # 合并所有批次的结果
+    # 按 scene_number 顺序合并所有批次的结果
+    results.sort(key=lambda item: item["scene_number"])
+    check_scene_prompts(scenes, results)
     final_result = json.dumps(results, ensure_ascii=False, indent=2)
     with open(output_path, "w", encoding="utf-8") as f:
         f.write(final_result)
-    logging.info(f"成功生成 {len(final_result)} 个场景提示词,保存为 scene_prompts.json")
-    return final_result
\ No newline at end of file
+    logging.info(f"成功生成 {len(results)} 个场景提示词,保存为 scene_prompts.json")
+
+# 估计每个场景输出的 JSON 对象中除 scene_detail 以外部分（主要是 prompt）的 token 数
+SCENE_OUTPUT_TOKENS = 350
+# 估计输出只占 max_output_tokens 的这一比例，为估计误差留出余量
+OUTPUT_BUDGET_RATIO = 0.8
+
+def pack_scene_batches(scenes, prompt, max_input_tokens, max_output_tokens):
+    """
+    按估计的 token 预算把连续的场景打包成批次：输入（系统提示词 + 场景 JSON）不超过 max_input_tokens，
+    估计输出（每个场景 SCENE_OUTPUT_TOKENS + 与原文相当的 scene_detail）不超过 max_output_tokens * OUTPUT_BUDGET_RATIO；
+    单个场景超出预算时自成一批
+    """
+    output_budget = max_output_tokens * OUTPUT_BUDGET_RATIO
+    prompt_tokens = estimate_tokens(prompt)
+    batches = []
+    batch, input_tokens, output_tokens = [], prompt_tokens, 0
+    for scene in scenes:
+        scene_input = estimate_tokens(json.dumps(scene, ensure_ascii=False, indent=2))
+        scene_output = SCENE_OUTPUT_TOKENS + estimate_tokens(scene["text"])
+        if batch and (input_tokens + scene_input > max_input_tokens or output_tokens + scene_output > output_budget):
+            batches.append(batch)
+            batch, input_tokens, output_tokens = [], prompt_tokens, 0
+        batch.append(scene)
+        input_tokens += scene_input
+        output_tokens += scene_output
+    if batch:
+        batches.append(batch)
+    return batches
+
+_DONE = object()
+
+def iter_scene_prompts(client, scenes, max_input_tokens, max_output_tokens, executor, cache=None):
+    """
+    并发、流式生成场景提示词：场景按 token 预算打包成批次，由 executor 并发发送
+    （响应被截断时立即拆半重试，其他失败先重试再拆半），响应边接收边增量解析，
+    每个场景的提示词对象一完整就立即产出；同一场景只产出第一次得到的提示词
+    """
+    prompt = get_prompt("generate_scene_prompts")
+    batches = pack_scene_batches(scenes, prompt, max_input_tokens, max_output_tokens)
+    logging.info(f"{len(scenes)} 个场景按 token 预算打包为 {len(batches)} 个批次")
+
+    items = queue.Queue()
+    emitted = set()
+    lock = threading.Lock()
+
+    def on_item(item):
+        with lock:
+            if item["scene_number"] in emitted:
+                return
+            emitted.add(item["scene_number"])
+        items.put(item)
+
+    def produce():
+        try:
+            executor.run(batches, lambda batch: request_scene_prompts(client, prompt, batch, max_output_tokens, cache, on_item))
+            items.put(_DONE)
+        except Exception as e:
+            items.put(e)
+
+    threading.Thread(target=produce, daemon=True).start()
+    while True:
+        item = items.get()
+        if item is _DONE:
+            return
+        if isinstance(item, Exception):
+            raise item
+        yield item
+
+def request_scene_prompts(client, prompt, batch, max_output_tokens, cache=None, on_item=None):
+    """
+    为一个批次的场景流式生成提示词，每解析出一个属于本批次的场景就调用 on_item
+    响应被截断时抛出 SplitBatch；不是有效 JSON 或与输入场景不一一对应时抛出 ValueError，由 BatchExecutor 重试
+    """
+    batch_story = json.dumps({"scenes": batch}, ensure_ascii=False, indent=2)
+    stream = CompletionStream(
+        client, cache, "generate_scene_prompts",
+        [
+            {"role": "system", "content": prompt},
+            {"role": "user", "content": batch_story}
+        ],
+        temperature=0.7,
+        max_tokens=max_output_tokens,
+    )
+    expected = {scene["scene_number"] for scene in batch}
+
+    batch_data = []
+    try:
+        for item in iter_json_array(stream):
+            batch_data.append(item)
+            if on_item is not None and is_scene_prompt(item) and item["scene_number"] in expected:
+                on_item(item)
+        check_scene_prompts(batch, batch_data)
+    except TruncatedJSONError as e:
+        stream.discard()
+        raise SplitBatch(f"场景 {batch[0]['scene_number']}-{batch[-1]['scene_number']} 的响应被截断（finish_reason={stream.finish_reason}）: {str(e)}")
+    except ValueError as e:
+        stream.discard()
+        raise ValueError(f"场景 {batch[0]['scene_number']}-{batch[-1]['scene_number']} 返回的提示词无效: {str(e)}")
+    stream.commit()
+    return batch_data
+
+def is_scene_prompt(item):
+    """是否为完整的场景提示词对象：整数 scene_number，字符串 scene_detail 与 prompt"""
+    return (
+        isinstance(item, dict)
+        and isinstance(item.get("scene_number"), int)
+        and isinstance(item.get("scene_detail"), str)
+        and isinstance(item.get("prompt"), str)
+    )
+
+def check_scene_prompts(scenes, prompts):
+    """校验每个输入场景恰好对应一条完整的提示词；字段缺失或拼错的对象视为无效，整批重试而不会写入缓存"""
+    if not isinstance(prompts, list) or not all(is_scene_prompt(item) for item in prompts):
+        raise ValueError("场景提示词应为包含 scene_number、scene_detail 与 prompt 的 JSON 列表")
+    expected = sorted(scene["scene_number"] for scene in scenes)
+    returned = sorted(item["scene_number"] for item in prompts)
+    if returned != expected:
+        missing = sorted(set(expected) - set(returned))
+        extra = sorted({n for n in returned if n not in expected or returned.count(n) > 1})
+        raise ValueError(f"场景提示词与输入场景不一一对应，缺少 {missing}，多余或重复 {extra}")
@@ -1,11 +1,23 @@
 import os
-from moviepy import AudioFileClip, ImageClip, CompositeVideoClip, concatenate_videoclips
-from moviepy import vfx, afx
+from moviepy import AudioFileClip, ImageClip, concatenate_videoclips
 import logging
 from PIL import Image, ImageDraw, ImageFont # type: ignore
 import numpy as np
 import json
+import subprocess
+import tempfile
+import shutil
+import hashlib
+import time
+from functools import lru_cache
+from bisect import bisect_left, bisect_right
+from concurrent.futures import ProcessPoolExecutor
 from utils.tools import clean_zh_text
+from utils.subtitle_file import write_srt, write_ass, ass_filter
+from utils.image_cache import prepare_scene_images, load_scene_image, file_digest, evict_scene_images
+
+VIDEO_HEIGHT = 720
+VIDEO_FPS = 24
 
 def generate_video(config):
     """
@@ -22,8 +34,11 @@ def generate_video(config):
     output_video = os.path.join(config["base"]["base_dir"], config["files"]["media"]["output_video"])
     subtitles_matched_scenes_path = os.path.join(config["base"]["base_dir"], config["files"]["text"]["subtitles_matched_scenes"])
     split_story_matched_subs_path = os.path.join(config["base"]["base_dir"], config["files"]["text"]["split_story_matched_subs"])
+    srt_path = os.path.join(config["base"]["base_dir"], config["files"]["text"]["subtitles_srt"])
+    sub_ass_path = os.path.join(config["base"]["base_dir"], config["files"]["text"]["subtitles_ass"])
     font_path = os.path.join(config["base"]["resources_dir"], "font", config["files"]["resources"]["font"])
     bg_mode = config["function"]["bg_mode"]
+    image_cache_dir = os.path.join(config["base"]["cache_dir"], "scene_images")
     with open(subtitles_path, "r", encoding="utf-8") as f:
         subtitles = json.load(f)
     with open(split_story_path, "r", encoding="utf-8") as f:
@@ -33,45 +48,655 @@ def generate_video(config):
     subtitles, split_story = add_time_to_split_story(subtitles, split_story, subtitles_matched_scenes_path, split_story_matched_subs_path, audio_duration)
     scene_timestamps = get_scene_timestamps(split_story)
 
-    audio_clip = AudioFileClip(audio_path)
+    # 字幕输出方式：burn 由 Python 绘制进画面；soft 封装为软字幕轨；libass 由 ffmpeg 按 ASS 样式烧录
+    render_backend = config["function"]["render_backend"]
+    subtitle_mode = config["function"]["subtitle_mode"]
+    output_profiles = config["function"]["output_profiles"]
+    if output_profiles:
+        # 多规格输出：一次构建时间线，由 ffmpeg split 同时编码所有规格
+        frame_size = get_frame_size(collect_scene_images(scene_timestamps, image_dir)[0][0])
+        write_subtitle_files(subtitles, srt_path, sub_ass_path, frame_size, font_path, bg_mode)
+        render_profiles_with_ffmpeg(
+            scene_timestamps, image_dir, audio_path, output_video, font_path, output_profiles,
+            sub_ass_path, srt_path, soft_subtitles=(subtitle_mode == "soft")
+        )
+        logging.info("视频生成完成！")
+        return
 
-    # 1. 生成图片片段序列
-    img_clips = []
+    ass_path = None
+    render_output = output_video
+    if subtitle_mode in ("soft", "libass"):
+        frame_size = get_frame_size(collect_scene_images(scene_timestamps, image_dir)[0][0])
+        write_subtitle_files(subtitles, srt_path, sub_ass_path, frame_size, font_path, bg_mode)
+        if subtitle_mode == "soft":
+            subtitles = []
+            render_output = os.path.join(os.path.dirname(output_video), f"render_{os.path.basename(output_video)}")
+        else:
+            ass_path = sub_ass_path
+            if render_backend == "moviepy":
+                render_output = os.path.join(os.path.dirname(output_video), f"render_{os.path.basename(output_video)}")
+    elif subtitle_mode != "burn":
+        raise ValueError(f"不支持的字幕模式: {subtitle_mode}")
+
+    if render_backend == "moviepy":
+        render_with_moviepy(scene_timestamps, [] if ass_path else subtitles, image_dir, audio_path, render_output, font_path, bg_mode, image_cache_dir)
+    elif render_backend == "ffmpeg":
+        render_with_ffmpeg(scene_timestamps, subtitles, image_dir, audio_path, render_output, font_path, bg_mode, ass_path)
+    elif render_backend == "event":
+        render_workers = config["function"]["render_workers"] or os.cpu_count() or 1
+        segment_dir = os.path.join(config["base"]["cache_dir"], "render_segments") if config["function"]["incremental_render"] else None
+        render_with_events(
+            scene_timestamps, subtitles, image_dir, audio_path, render_output, font_path, bg_mode, image_cache_dir,
+            render_workers, segment_dir, config["function"]["render_segment_seconds"], ass_path
+        )
+    else:
+        raise ValueError(f"不支持的渲染后端: {render_backend}")
+    if render_backend != "ffmpeg" and config["function"]["scene_image_cache_mb"]:
+        # 本次使用的缓存刚刚更新过访问时间，优先淘汰其他故事留下的旧图片
+        evict_scene_images(image_cache_dir, int(config["function"]["scene_image_cache_mb"] * 1024 * 1024))
+
+    if subtitle_mode == "soft":
+        mux_soft_subtitles(render_output, srt_path, output_video)
+        os.remove(render_output)
+    elif render_output != output_video:
+        burn_ass_subtitles(render_output, sub_ass_path, font_path, output_video)
+        os.remove(render_output)
+    logging.info("视频生成完成！")
+
+def write_subtitle_files(subtitles, srt_path, ass_path, frame_size, font_path, bg_mode):
+    """导出 SRT 和与 Pillow 字幕样式一致的 ASS 文件"""
+    write_srt(subtitles, srt_path)
+    font_name = load_font(font_path, SUBTITLE_FONT_SIZE).getname()[0]
+    write_ass(
+        subtitles, ass_path, frame_size, font_name,
+        font_size=SUBTITLE_FONT_SIZE,
+        bottom_margin=SUBTITLE_BOTTOM_MARGIN + SUBTITLE_PADDING,
+        # 底框留白取行距，使多行字幕的底框连成一片
+        box_padding=SUBTITLE_LINE_SPACING,
+        bg_mode=bg_mode,
+        fade=SUBTITLE_FADE,
+    )
+
+def mux_soft_subtitles(video_path, srt_path, output_video):
+    """将 SRT 作为软字幕轨封装进视频，音视频流直接复制"""
+    cmd = [
+        "ffmpeg", "-y",
+        "-i", video_path, "-i", srt_path,
+        "-map", "0:v", "-map", "0:a", "-map", "1:s",
+        "-c:v", "copy", "-c:a", "copy", "-c:s", "mov_text",
+        "-metadata:s:s:0", "language=chi",
+        output_video,
+    ]
+    subprocess.run(cmd, check=True)
+    logging.info(f"软字幕已封装到 {output_video}")
+
+def burn_ass_subtitles(video_path, ass_path, font_path, output_video):
+    """用 libass 把 ASS 字幕烧录进画面，音频直接复制"""
+    cmd = [
+        "ffmpeg", "-y",
+        "-i", video_path,
+        "-vf", ass_filter(ass_path, os.path.dirname(font_path)),
+        "-c:v", "libx264", "-pix_fmt", "yuv420p",
+        "-c:a", "copy",
+        output_video,
+    ]
+    subprocess.run(cmd, check=True)
+    logging.info(f"ASS 字幕已烧录到 {output_video}")
+
+def collect_scene_images(scene_timestamps, image_dir):
+    """
+    按顺序返回可用的 (图片路径, 时长) 列表，跳过图片缺失或时长无效的场景
+    """
+    scene_images = []
     for i, ts in enumerate(scene_timestamps):
         img_path = os.path.join(image_dir, f"scene_{i:02d}.png")
         if not os.path.exists(img_path) or ts["duration"] <= 0:
             logging.warning(f"图片文件不存在或时长无效: {img_path}")
             continue
-        img_clip = ImageClip(img_path, duration=ts["duration"]).resized(height=720)
-        img_clips.append(img_clip)
-    if not img_clips:
+        scene_images.append((img_path, ts["duration"]))
+    if not scene_images:
         logging.error("没有可用的图片片段，无法生成视频")
         raise ValueError("没有可用的图片片段")
+    return scene_images
+
+def render_with_moviepy(scene_timestamps, subtitles, image_dir, audio_path, output_video, font_path, bg_mode, image_cache_dir):
+    """使用 moviepy 逐帧合成并编码视频"""
+    audio_clip = AudioFileClip(audio_path)
+
+    # 1. 生成图片片段序列（预缩放的图片以内存映射方式读取）
+    scene_images = collect_scene_images(scene_timestamps, image_dir)
+    frame_size = get_frame_size(scene_images[0][0])
+    cache_paths = prepare_scene_images([img_path for img_path, _ in scene_images], frame_size, image_cache_dir)
+    img_clips = []
+    for cache_path, (_, duration) in zip(cache_paths, scene_images):
+        img_clip = ImageClip(load_scene_image(cache_path), duration=duration)
+        img_clips.append(img_clip)
     img_video = concatenate_videoclips(img_clips)
 
-    # 2. 生成字幕片段序列
-    subtitle_clips = []
-    for sub in subtitles:
-        text = sub["text"]
-        start = sub["start"]
-        end = sub["end"]
-        duration = round(end - start, 2)
-        subtitle_clip = create_subtitle_clip(text, duration, img_video.size, font_path, bg_mode=bg_mode)
-        subtitle_clip = subtitle_clip.with_start(start)
-        print(f"subtitle_clip: {subtitle_clip.duration}, {subtitle_clip.size}")
-        subtitle_clips.append(subtitle_clip)
-    if subtitle_clips:
-        all_subtitles = CompositeVideoClip(subtitle_clips, size=img_video.size)
+    # 2. 生成字幕轨道：每帧只查询当前显示的字幕，而不是让 moviepy 遍历所有字幕片段
+    track = SubtitleTrack(subtitles)
+    if len(track):
+        frame_size = tuple(img_video.size)
+
+        def draw_subtitles(get_frame, t):
+            return composite_frame(get_frame(t), track.overlays_at(t, frame_size, font_path, bg_mode))
+
         # 3. 合成最终视频
-        final_video = CompositeVideoClip([img_video, all_subtitles], size=img_video.size)
+        final_video = img_video.transform(draw_subtitles)
         final_video = final_video.with_audio(audio_clip)
     else:
         logging.info("没有字幕片段，只保留图片")
         final_video = img_video.with_audio(audio_clip)
     
-    final_video.write_videofile(output_video, fps=24, write_logfile=True)
+    final_video.write_videofile(output_video, fps=VIDEO_FPS, write_logfile=True)
     final_video.close()
-    logging.info("视频生成完成！")
+
+def get_frame_size(img_path, height=VIDEO_HEIGHT):
+    """按图片比例计算输出画面尺寸，宽度取偶数以满足 yuv420p"""
+    with Image.open(img_path) as img:
+        w, h = img.size
+    width = int(round(w * height / h / 2)) * 2
+    return (width, height)
+
+def escape_ffconcat_path(path):
+    """concat 脚本中的路径需用单引号包裹，内部单引号需转义"""
+    return "'" + os.path.abspath(path).replace("'", "'\\''") + "'"
+
+def write_scene_concat_script(scene_images, script_path):
+    """
+    生成 ffmpeg concat demuxer 脚本，每张场景图片按其时长显示
+    最后一张图片需要重复一次，否则其 duration 不生效
+    """
+    lines = ["ffconcat version 1.0"]
+    for img_path, duration in scene_images:
+        lines.append(f"file {escape_ffconcat_path(img_path)}")
+        lines.append(f"duration {duration:.3f}")
+    lines.append(f"file {escape_ffconcat_path(scene_images[-1][0])}")
+    with open(script_path, "w", encoding="utf-8") as f:
+        f.write("\n".join(lines) + "\n")
+
+def build_subtitle_stream(subtitles, frame_size, font_path, bg_mode, work_dir):
+    """
+    把全部字幕合成为一路透明字幕层，交给 ffmpeg 作为单个输入、单个 overlay 叠加：
+    字幕层只覆盖画面底部的字幕条带，只在字幕变化时写出新的 PNG（相同画面共用一张），
+    淡入淡出区间逐帧写出，再由 concat demuxer 按帧数拼接
+
+    Returns:
+        tuple: (concat 脚本路径, 条带左上角 y 坐标)；没有字幕时返回 None
+    """
+    track = SubtitleTrack(subtitles)
+    if not len(track):
+        return None
+    frame_size = tuple(frame_size)
+    # 条带高度只需按换行结果计算各字幕位图的高度，不绘制、不保留位图
+    band_bottom = frame_size[1] - SUBTITLE_BOTTOM_MARGIN
+    band_y = max(band_bottom - max(subtitle_image_height(sub["text"], frame_size, font_path) for sub in track.subtitles), 0)
+    band_y -= band_y % 2 # yuv420p 下叠加位置取偶数
+    band_size = (frame_size[0], band_bottom - band_y)
+
+    layers = {}
+
+    def layer_path(t, active):
+        # 同一组字幕、同一透明度的画面只绘制并写出一次
+        key = tuple((idx, round(track.alpha(idx, t), 4)) for idx in active)
+        if key not in layers:
+            path = os.path.join(work_dir, f"subs_{len(layers):05d}.png")
+            layer = composite_subtitle_layer(band_size, track.overlays_at(t, frame_size, font_path, bg_mode, active), (0, band_y))
+            Image.fromarray(layer, "RGBA").save(path, compress_level=1)
+            layers[key] = path
+        return layers[key]
+
+    entries = [] # [(PNG 路径, 帧数)]
+    events = build_change_events([], track.subtitles, 0.0, max(track.ends))
+    for seg_start, seg_end in zip(events[:-1], events[1:]):
+        first, last = first_frame_at(seg_start), first_frame_at(seg_end)
+        if first >= last:
+            continue
+        mid = (seg_start + seg_end) / 2
+        active = track.active(mid)
+        if not any(track.alpha(idx, mid) < 1.0 for idx in active):
+            entries.append((layer_path(mid, active), last - first))
+        else:
+            for n in range(first, last):
+                entries.append((layer_path(n / VIDEO_FPS, active), 1))
+    # 最后一条字幕消失后保持透明
+    entries.append((layer_path(0.0, []), 1))
+
+    merged = []
+    for path, frames in entries:
+        if merged and merged[-1][0] == path:
+            merged[-1][1] += frames
+        else:
+            merged.append([path, frames])
+
+    concat_path = os.path.join(work_dir, "subtitles.ffconcat")
+    lines = ["ffconcat version 1.0"]
+    for path, frames in merged:
+        lines.append(f"file {escape_ffconcat_path(path)}")
+        lines.append(f"duration {frames / VIDEO_FPS:.6f}")
+    lines.append(f"file {escape_ffconcat_path(merged[-1][0])}")
+    with open(concat_path, "w", encoding="utf-8") as f:
+        f.write("\n".join(lines) + "\n")
+    logging.info(f"字幕层共 {len(track)} 条字幕，写出 {len(layers)} 张不同画面")
+    return concat_path, band_y
+
+def render_with_ffmpeg(scene_timestamps, subtitles, image_dir, audio_path, output_video, font_path, bg_mode, ass_path=None):
+    """
+    使用 ffmpeg 完成全部合成与编码：场景图片通过 concat demuxer 按时长拼接，
+    字幕合成为一路透明字幕层后用单个 overlay 叠加，不经过 Python 逐帧合成；指定 ass_path 时改用 libass 烧录字幕
+    """
+    scene_images = collect_scene_images(scene_timestamps, image_dir)
+    frame_size = get_frame_size(scene_images[0][0])
+
+    with tempfile.TemporaryDirectory(prefix="ffmpeg_render_") as work_dir:
+        concat_path = os.path.join(work_dir, "scenes.ffconcat")
+        write_scene_concat_script(scene_images, concat_path)
+
+        filters = [
+            f"[0:v]scale={frame_size[0]}:{frame_size[1]},setsar=1,fps={VIDEO_FPS},format=yuv420p[base]"
+        ]
+        sub_inputs, video_label = [], "base"
+        if ass_path:
+            video_label = "vass"
+            filters.append(f"[base]{ass_filter(ass_path, os.path.dirname(font_path))}[vass]")
+        else:
+            subtitle_stream = build_subtitle_stream(subtitles, frame_size, font_path, bg_mode, work_dir)
+            if subtitle_stream:
+                subtitle_concat_path, band_y = subtitle_stream
+                sub_inputs = ["-f", "concat", "-safe", "0", "-i", subtitle_concat_path]
+                # 字幕层重采样到与画面相同的帧时间，单个 overlay 叠加
+                filters.append(f"[1:v]fps={VIDEO_FPS},format=rgba[subs]")
+                filters.append(f"[base][subs]overlay=0:{band_y}:eof_action=pass[vsub]")
+                video_label = "vsub"
+            else:
+                logging.info("没有字幕片段，只保留图片")
+        audio_index = 1 + sub_inputs.count("-i")
+
+        filter_script_path = os.path.join(work_dir, "filtergraph.txt")
+        with open(filter_script_path, "w", encoding="utf-8") as f:
+            f.write(";\n".join(filters))
+
+        cmd = [
+            "ffmpeg", "-y",
+            "-f", "concat", "-safe", "0", "-i", concat_path,
+            *sub_inputs,
+            "-i", audio_path,
+            "-filter_complex_script", filter_script_path,
+            "-map", f"[{video_label}]", "-map", f"{audio_index}:a",
+            "-c:v", "libx264", "-pix_fmt", "yuv420p", "-r", str(VIDEO_FPS),
+            "-c:a", "libmp3lame",
+            "-shortest",
+            output_video,
+        ]
+        logging.info(f"使用 ffmpeg 渲染视频，共 {len(scene_images)} 个场景")
+        subprocess.run(cmd, check=True)
+
+def profile_output_path(output_video, profile):
+    """多规格输出的文件名：在原文件名后加上规格名"""
+    stem, ext = os.path.splitext(output_video)
+    return f"{stem}_{profile['name']}{ext}"
+
+def render_profiles_with_ffmpeg(scene_timestamps, image_dir, audio_path, output_video, font_path, profiles, ass_path, srt_path, soft_subtitles=False):
+    """
+    单次渲染输出多种规格：场景图片只由 concat demuxer 解码一次，经 split 分流后
+    每一路各自缩放、按需用 libass 烧录字幕（soft_subtitles 时改为封装软字幕轨），并以各自码率编码
+    所有编码器在同一个 ffmpeg 进程中并行运行
+
+    profiles: [{"name", "height", "width"(可选), "bitrate"(可选), "subtitles"(可选, 默认 True)}]
+    """
+    scene_images = collect_scene_images(scene_timestamps, image_dir)
+    fonts_dir = os.path.dirname(font_path)
+
+    with tempfile.TemporaryDirectory(prefix="ffmpeg_profiles_") as work_dir:
+        concat_path = os.path.join(work_dir, "scenes.ffconcat")
+        write_scene_concat_script(scene_images, concat_path)
+
+        splits = "".join(f"[p{i}]" for i in range(len(profiles)))
+        filters = [f"[0:v]fps={VIDEO_FPS},setsar=1,split={len(profiles)}{splits}"]
+        for i, profile in enumerate(profiles):
+            height = profile["height"]
+            width = profile.get("width")
+            burn = profile.get("subtitles", True) and not soft_subtitles
+            chain = [f"scale=-2:{height}" if not width else f"scale={width}:{height}:force_original_aspect_ratio=decrease,scale=trunc(iw/2)*2:trunc(ih/2)*2"]
+            if burn:
+                # 在补边之前烧录，字幕位于画面内且不被拉伸
+                chain.append(ass_filter(ass_path, fonts_dir))
+            if width:
+                chain.append(f"pad={width}:{height}:(ow-iw)/2:(oh-ih)/2")
+            chain += ["setsar=1", "format=yuv420p"]
+            filters.append(f"[p{i}]{','.join(chain)}[o{i}]")
+
+        filter_script_path = os.path.join(work_dir, "filtergraph.txt")
+        with open(filter_script_path, "w", encoding="utf-8") as f:
+            f.write(";\n".join(filters))
+
+        cmd = [
+            "ffmpeg", "-y",
+            "-f", "concat", "-safe", "0", "-i", concat_path,
+            "-i", audio_path,
+            "-i", srt_path,
+            "-filter_complex_script", filter_script_path,
+        ]
+        for i, profile in enumerate(profiles):
+            cmd += ["-map", f"[o{i}]", "-map", "1:a"]
+            if soft_subtitles and profile.get("subtitles", True):
+                cmd += ["-map", "2:s", "-c:s", "mov_text", "-metadata:s:s:0", "language=chi"]
+            cmd += ["-c:v", "libx264", "-pix_fmt", "yuv420p", "-r", str(VIDEO_FPS)]
+            if profile.get("bitrate"):
+                cmd += ["-b:v", profile["bitrate"], "-maxrate", profile["bitrate"], "-bufsize", profile["bitrate"]]
+            cmd += ["-c:a", "copy", "-shortest", profile_output_path(output_video, profile)]
+        logging.info(f"单次渲染输出 {len(profiles)} 种规格: {', '.join(profile['name'] for profile in profiles)}")
+        subprocess.run(cmd, check=True)
+
+def build_scene_spans(scene_images):
+    """把 (图片路径, 时长) 序列转换为首尾相接的 (图片路径, start, end)"""
+    spans = []
+    t = 0.0
+    for img_path, scene_duration in scene_images:
+        spans.append((img_path, t, t + scene_duration))
+        t += scene_duration
+    return spans
+
+def build_change_events(scene_spans, subtitles, t_start, t_end):
+    """
+    收集 [t_start, t_end] 内画面可能发生变化的时间点：场景切换、字幕出现/消失以及淡入淡出的起止
+    相邻两个事件之间若不处于淡入淡出区间，画面保持不变
+    """
+    events = {t_start, t_end}
+    for _, _, scene_end in scene_spans:
+        events.add(scene_end)
+    for sub in subtitles:
+        start, end = sub["start"], sub["end"]
+        events.update([start, min(start + SUBTITLE_FADE, end), max(end - SUBTITLE_FADE, start), end])
+    return sorted(e for e in events if t_start <= e <= t_end)
+
+def composite_frame(scene_frame, overlays):
+    """
+    将字幕位图按透明度叠加到场景画面上
+    overlays: [(rgba数组, (x, y), 透明度系数)]
+    """
+    if not overlays:
+        return scene_frame
+    frame = scene_frame.astype(np.float32)
+    frame_h, frame_w = frame.shape[:2]
+    for rgba, (x, y), factor in overlays:
+        h, w = rgba.shape[:2]
+        # 超出画面的部分裁掉
+        x0, y0 = max(x, 0), max(y, 0)
+        x1, y1 = min(x + w, frame_w), min(y + h, frame_h)
+        if x0 >= x1 or y0 >= y1:
+            continue
+        patch = rgba[y0 - y:y1 - y, x0 - x:x1 - x]
+        alpha = patch[:, :, 3:4].astype(np.float32) * (factor / 255.0)
+        region = frame[y0:y1, x0:x1]
+        frame[y0:y1, x0:x1] = region * (1.0 - alpha) + patch[:, :, :3] * alpha
+    return np.clip(frame + 0.5, 0, 255).astype(np.uint8)
+
+def composite_subtitle_layer(layer_size, overlays, origin=(0, 0)):
+    """
+    将字幕位图按透明度叠加到透明画布上（alpha over 合成），返回 RGBA 数组
+    画布左上角位于画面坐标 origin，overlays 格式同 composite_frame
+    """
+    width, height = layer_size
+    color = np.zeros((height, width, 3), dtype=np.float32) # 预乘 alpha 的颜色
+    coverage = np.zeros((height, width, 1), dtype=np.float32)
+    for rgba, (x, y), factor in overlays:
+        x, y = x - origin[0], y - origin[1]
+        h, w = rgba.shape[:2]
+        x0, y0 = max(x, 0), max(y, 0)
+        x1, y1 = min(x + w, width), min(y + h, height)
+        if x0 >= x1 or y0 >= y1:
+            continue
+        patch = rgba[y0 - y:y1 - y, x0 - x:x1 - x]
+        alpha = patch[:, :, 3:4].astype(np.float32) * (factor / 255.0)
+        color[y0:y1, x0:x1] = patch[:, :, :3] * alpha + color[y0:y1, x0:x1] * (1.0 - alpha)
+        coverage[y0:y1, x0:x1] = alpha + coverage[y0:y1, x0:x1] * (1.0 - alpha)
+    rgb = color / np.maximum(coverage, 1e-6)
+    layer = np.concatenate([rgb, coverage * 255.0], axis=2)
+    return np.clip(layer + 0.5, 0, 255).astype(np.uint8)
+
+def first_frame_at(t, fps=VIDEO_FPS):
+    """时间 t 之后（含）的第一帧序号"""
+    return int(np.ceil(t * fps - 1e-6))
+
+def render_with_events(scene_timestamps, subtitles, image_dir, audio_path, output_video, font_path, bg_mode, image_cache_dir, render_workers=1, segment_dir=None, segment_seconds=30, ass_path=None):
+    """
+    事件驱动渲染：只在画面发生变化时合成新帧，其余时间把上一帧的原始数据重复写给编码器，
+    得到与逐帧合成一致的恒定帧率视频。render_workers > 1 时按场景分块并行渲染；
+    指定 segment_dir 时按 segment_seconds 分段并缓存编码结果，只重新编码输入有变化的片段
+    指定 ass_path 时字幕由编码器中的 libass 烧录，Python 只合成场景图片
+    """
+    scene_images = collect_scene_images(scene_timestamps, image_dir)
+    frame_size = get_frame_size(scene_images[0][0])
+    # 场景图片预先缩放并缓存，渲染时按需内存映射读取
+    cache_paths = prepare_scene_images([img_path for img_path, _ in scene_images], frame_size, image_cache_dir)
+    scene_spans = build_scene_spans([(cache_path, duration) for cache_path, (_, duration) in zip(cache_paths, scene_images)])
+    total_frames = first_frame_at(scene_spans[-1][2])
+    if segment_dir:
+        chunks = split_scene_spans(scene_spans, segment_seconds)
+        render_chunks_in_parallel(chunks, subtitles, frame_size, total_frames, audio_path, output_video, font_path, bg_mode, render_workers, segment_dir, ass_path)
+    elif render_workers > 1 and len(scene_spans) > 1:
+        chunks = split_scene_spans(scene_spans, scene_spans[-1][2] / render_workers)
+        render_chunks_in_parallel(chunks, subtitles, frame_size, total_frames, audio_path, output_video, font_path, bg_mode, render_workers, None, ass_path)
+    else:
+        render_event_frames(scene_spans, subtitles, frame_size, 0, total_frames, font_path, bg_mode, output_video, audio_path, ass_path)
+
+def render_event_frames(scene_spans, subtitles, frame_size, first_frame, last_frame, font_path, bg_mode, output_video, audio_path=None, ass_path=None):
+    """
+    合成并编码全局帧序号 [first_frame, last_frame) 的画面，时间均为全局时间，
+    因此跨越分块边界的字幕也能得到正确的淡入淡出
+    scene_spans 中的路径为预处理后的场景图片缓存；audio_path 为 None 时只输出视频流
+    ass_path 不为空时字幕交给 libass 烧录，不再由 Python 合成
+    """
+    if ass_path:
+        subtitles = []
+    t_start, t_end = first_frame / VIDEO_FPS, last_frame / VIDEO_FPS
+    events = build_change_events(scene_spans, subtitles, t_start, t_end)
+
+    scene_ends = np.array([scene_end for _, _, scene_end in scene_spans])
+    track = SubtitleTrack(subtitles)
+
+    cmd = [
+        "ffmpeg", "-y", "-loglevel", "error",
+        "-f", "rawvideo", "-pix_fmt", "rgb24", "-s", f"{frame_size[0]}x{frame_size[1]}", "-r", str(VIDEO_FPS), "-i", "-",
+    ]
+    if audio_path:
+        cmd += ["-i", audio_path, "-map", "0:v", "-map", "1:a", "-c:a", "libmp3lame", "-shortest"]
+    else:
+        cmd += ["-an"]
+    if ass_path:
+        # 先把时间戳平移到全局时间再烧录字幕，之后恢复从 0 开始，分块渲染时字幕时间同样正确
+        cmd += ["-vf", f"setpts=PTS+{t_start:.6f}/TB,{ass_filter(ass_path, os.path.dirname(font_path))},setpts=PTS-STARTPTS"]
+    cmd += ["-c:v", "libx264", "-pix_fmt", "yuv420p", output_video]
+    proc = subprocess.Popen(cmd, stdin=subprocess.PIPE)
+
+    scene_idx = -1
+    scene_frame = None
+    composited = 0
+    try:
+        for seg_start, seg_end in zip(events[:-1], events[1:]):
+            first, last = max(first_frame_at(seg_start), first_frame), min(first_frame_at(seg_end), last_frame)
+            if first >= last:
+                continue
+            mid = (seg_start + seg_end) / 2
+
+            # 切换场景图片，只保留当前场景在内存中
+            current_scene = min(int(np.searchsorted(scene_ends, mid, side="right")), len(scene_spans) - 1)
+            if current_scene != scene_idx:
+                scene_idx = current_scene
+                scene_frame = load_scene_image(scene_spans[scene_idx][0])
+
+            # 当前区间内显示的字幕；区间内不含淡入淡出时画面静止
+            active = track.active(mid)
+            fading = any(track.alpha(idx, mid) < 1.0 for idx in active)
+            if not fading:
+                # 静止区间：合成一次，重复写入
+                frame = composite_frame(scene_frame, track.overlays_at(mid, frame_size, font_path, bg_mode))
+                composited += 1
+                data = frame.tobytes()
+                for _ in range(last - first):
+                    proc.stdin.write(data)
+            else:
+                # 淡入淡出区间：逐帧合成
+                for n in range(first, last):
+                    t = n / VIDEO_FPS
+                    overlays = track.overlays_at(t, frame_size, font_path, bg_mode, active)
+                    proc.stdin.write(composite_frame(scene_frame, overlays).tobytes())
+                    composited += 1
+    finally:
+        proc.stdin.close()
+        returncode = proc.wait()
+    if returncode != 0:
+        raise subprocess.CalledProcessError(returncode, cmd)
+    logging.info(f"帧 {first_frame}-{last_frame} 渲染完成：共 {last_frame - first_frame} 帧，实际合成 {composited} 帧")
+
+def split_scene_spans(scene_spans, target_seconds):
+    """
+    在场景边界处把时间线切成约 target_seconds 长的若干块，返回每块的场景列表
+    切分点只取决于它之前的场景时长，修改后面的内容不会改变前面的分块
+    """
+    chunks = [[]]
+    for span in scene_spans:
+        chunks[-1].append(span)
+        if span[2] >= target_seconds * len(chunks):
+            chunks.append([])
+    return [chunk for chunk in chunks if chunk]
+
+SEGMENT_FORMAT_VERSION = 1
+
+def segment_input_hash(chunk, chunk_subs, frame_size, first_frame, last_frame, font_digest, bg_mode, burn_with_libass=False):
+    """
+    计算片段全部输入的哈希：场景图片（缓存文件名已包含内容哈希和尺寸）、字幕文本与时间、帧范围和渲染设置
+    音轨在最终封装时整体复制，不参与片段哈希
+    """
+    payload = {
+        "version": SEGMENT_FORMAT_VERSION,
+        "fps": VIDEO_FPS,
+        "frame_size": list(frame_size),
+        "frames": [first_frame, last_frame],
+        "scenes": [[os.path.basename(path), start, end] for path, start, end in chunk],
+        "subtitles": [[sub["text"], sub["start"], sub["end"]] for sub in chunk_subs],
+        "font": font_digest,
+        "bg_mode": bg_mode,
+        "libass": burn_with_libass,
+    }
+    return hashlib.sha256(json.dumps(payload, ensure_ascii=False, sort_keys=True).encode("utf-8")).hexdigest()
+
+def segment_manifest_path(segment_dir, output_video):
+    """每个输出文件一份片段清单，按输出路径的哈希命名"""
+    key = hashlib.sha256(os.path.abspath(output_video).encode("utf-8")).hexdigest()[:16]
+    return os.path.join(segment_dir, "manifests", f"{key}.json")
+
+def save_segment_manifest(segment_dir, output_video, segments):
+    """记录输出文件本次拼接所用的片段（按顺序），覆盖该输出之前的清单"""
+    manifest_path = segment_manifest_path(segment_dir, output_video)
+    os.makedirs(os.path.dirname(manifest_path), exist_ok=True)
+    tmp_path = f"{manifest_path}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump({"output": os.path.abspath(output_video), "segments": segments}, f, ensure_ascii=False, indent=2)
+    os.replace(tmp_path, manifest_path)
+
+def remove_unreferenced_segments(segment_dir, started):
+    """
+    删除不被任何清单引用的片段；started 之后写入的片段可能属于同时进行的其他渲染，暂不删除
+    """
+    referenced = set()
+    manifests_dir = os.path.join(segment_dir, "manifests")
+    for entry in os.scandir(manifests_dir):
+        if entry.name.endswith(".json"):
+            with open(entry.path, "r", encoding="utf-8") as f:
+                referenced.update(segment["hash"] for segment in json.load(f)["segments"])
+    removed = 0
+    for entry in os.scandir(segment_dir):
+        if not entry.is_file() or not entry.name.endswith(".mp4"):
+            continue
+        if entry.name[:-len(".mp4")] in referenced or entry.stat().st_mtime >= started:
+            continue
+        try:
+            os.remove(entry.path)
+            removed += 1
+        except FileNotFoundError:
+            pass
+    if removed:
+        logging.info(f"删除 {removed} 个不再被引用的缓存片段")
+
+def render_chunks_in_parallel(chunks, subtitles, frame_size, total_frames, audio_path, output_video, font_path, bg_mode, render_workers, segment_dir=None, ass_path=None):
+    """
+    多进程分块渲染：每块只包含自己的场景和与之重叠的字幕，渲染为无音频的视频，
+    再用 concat demuxer 流复制拼接，最后一次性复制整条音轨，避免分段音频在接缝处产生间隙
+    指定 segment_dir 时片段以输入哈希命名并保留，输入未变的片段直接复用；
+    每个输出文件在 segment_dir/manifests 下记录所用片段，拼接完成后删除不被任何清单引用的片段
+    """
+    logging.info(f"时间线切分为 {len(chunks)} 块，使用 {render_workers} 个进程并行渲染")
+    if segment_dir:
+        started = time.time()
+        os.makedirs(segment_dir, exist_ok=True)
+        segments = []
+        font_digest = file_digest(font_path)
+
+    with tempfile.TemporaryDirectory(prefix="chunk_render_") as work_dir:
+        chunk_paths = []
+        jobs = []
+        reused = 0
+        for idx, chunk in enumerate(chunks):
+            chunk_start, chunk_end = chunk[0][1], chunk[-1][2]
+            # 分块边界对齐到全局帧序号，拼接后帧时间与单进程渲染一致
+            first_frame = first_frame_at(chunk_start)
+            last_frame = total_frames if idx == len(chunks) - 1 else first_frame_at(chunk_end)
+            chunk_subs = [sub for sub in subtitles if sub["start"] < chunk_end and sub["end"] > chunk_start]
+            if segment_dir:
+                segment_hash = segment_input_hash(chunk, chunk_subs, frame_size, first_frame, last_frame, font_digest, bg_mode, bool(ass_path))
+                chunk_path = os.path.join(segment_dir, f"{segment_hash}.mp4")
+                segments.append({
+                    "hash": segment_hash,
+                    "first_frame": first_frame,
+                    "last_frame": last_frame,
+                    "scenes": len(chunk),
+                    "subtitles": len(chunk_subs),
+                })
+                if os.path.exists(chunk_path):
+                    reused += 1
+                    chunk_paths.append(chunk_path)
+                    continue
+            else:
+                chunk_path = os.path.join(work_dir, f"chunk_{idx:03d}.mp4")
+            chunk_paths.append(chunk_path)
+            jobs.append((chunk, chunk_subs, first_frame, last_frame, chunk_path))
+
+        if segment_dir:
+            logging.info(f"增量渲染：复用 {reused} 个片段，重新编码 {len(jobs)} 个片段")
+        with ProcessPoolExecutor(max_workers=render_workers) as executor:
+            futures = []
+            for chunk, chunk_subs, first_frame, last_frame, chunk_path in jobs:
+                # 先写入临时文件，编码中断时不会留下不完整的缓存片段
+                tmp_path = os.path.join(work_dir, f"{os.path.basename(chunk_path)}.tmp.mp4")
+                futures.append((executor.submit(
+                    render_event_frames, chunk, chunk_subs, frame_size, first_frame, last_frame, font_path, bg_mode, tmp_path, None, ass_path
+                ), tmp_path, chunk_path))
+            for future, tmp_path, chunk_path in futures:
+                future.result()
+                shutil.move(tmp_path, chunk_path)
+
+        concat_path = os.path.join(work_dir, "chunks.ffconcat")
+        with open(concat_path, "w", encoding="utf-8") as f:
+            f.write("ffconcat version 1.0\n")
+            for chunk_path in chunk_paths:
+                f.write(f"file {escape_ffconcat_path(chunk_path)}\n")
+        cmd = [
+            "ffmpeg", "-y",
+            "-f", "concat", "-safe", "0", "-i", concat_path,
+            "-i", audio_path,
+            "-map", "0:v", "-map", "1:a",
+            "-c", "copy",
+            "-shortest",
+            output_video,
+        ]
+        subprocess.run(cmd, check=True)
+
+    if segment_dir:
+        # 拼接成功后才更新清单，再清理其他输出也不再使用的旧片段
+        save_segment_manifest(segment_dir, output_video, segments)
+        remove_unreferenced_segments(segment_dir, started)
 
 def add_time_to_split_story(subtitles, split_story, subtitles_matched_scenes_path, split_story_matched_subs_path, audio_duration=None):
     """
@@ -85,16 +710,16 @@ def add_time_to_split_story(subtitles, split_story, subtitles_matched_scenes_pat
         scene["duration"] = 0.0
         scene["matched_subs"] = []
 
+    # 每段文本只清洗一次；已消耗的场景总是前缀，用游标代替每条字幕从头扫描
+    scene_texts = [clean_zh_text(scene["text"]) for scene in split_story]
+    cursor = 0
     sub_matched = False
     for i, sub in enumerate(subtitles):
-        if i == 80:
-            pass
         sub_text = clean_zh_text(sub["text"])
         sub["matched_scenes"] = []
-        for scene in split_story:
-            if scene["consumed"]:
-                continue
-            scene_text = clean_zh_text(scene["text"])
+        while cursor < len(split_story):
+            scene = split_story[cursor]
+            scene_text = scene_texts[cursor]
             if len(sub_text) <= len(scene_text):
                 # 字幕较短，判断字幕是否被场景包含
                 if sub_text in scene_text:
@@ -104,10 +729,12 @@ def add_time_to_split_story(subtitles, split_story, subtitles_matched_scenes_pat
                     break
                 else:
                     scene["consumed"] = True
+                    cursor += 1
                     continue
             else:
                 if sub_matched:
                     scene["consumed"] = True
+                    cursor += 1
                     sub_matched = False
                     continue
                 # 字幕较长，判断场景是否被字幕包含
@@ -115,6 +742,7 @@ def add_time_to_split_story(subtitles, split_story, subtitles_matched_scenes_pat
                     sub["matched_scenes"].append(scene["scene_number"])
                     scene["matched_subs"].append(i)
                     scene["consumed"] = True
+                    cursor += 1
                 else:
                     break
 
@@ -123,6 +751,9 @@ def add_time_to_split_story(subtitles, split_story, subtitles_matched_scenes_pat
         audio_duration = max((sub["end"] for sub in subtitles if "end" in sub), default=0.0)
 
     # Step 1: 分配每个 scene 的初步时间
+    scenes_by_number = {}
+    for scene in split_story:
+        scenes_by_number.setdefault(scene["scene_number"], scene)
     for scene in split_story:
         matched_subs = scene.get("matched_subs", [])
         if not matched_subs:
@@ -147,7 +778,7 @@ def add_time_to_split_story(subtitles, split_story, subtitles_matched_scenes_pat
                 total_duration = sub["end"] - sub["start"]
                 per_duration = total_duration / len(matched)
                 for j, scn_num in enumerate(matched):
-                    scn = next((s for s in split_story if s["scene_number"] == scn_num), None)
+                    scn = scenes_by_number.get(scn_num)
                     if scn:
                         scn_start = sub["start"] + j * per_duration
                         scn_end = sub["start"] + (j + 1) * per_duration if j < len(matched) - 1 else sub["end"]
@@ -205,38 +836,71 @@ def get_scene_timestamps(split_story):
         logging.info(f"场景{idx}: start={ts['start']}, end={ts['end']}, duration={ts['duration']}")
     return scene_timestamps
 
-def create_subtitle_clip(text, duration, img_size, font_path, bg_mode="dynamic"):
-    """使用Pillow绘制自动换行、垂直居中的字幕"""
-    width, height = img_size
-    font_size = 30
-    font = ImageFont.truetype(font_path, font_size)
+SUBTITLE_FONT_SIZE = 30
+SUBTITLE_LINE_SPACING = 10
+SUBTITLE_PADDING = 20
+SUBTITLE_BOTTOM_MARGIN = 20
+SUBTITLE_FADE = 0.3
 
-    # 自动换行
-    max_text_width = int(width * 0.9)  # 限制文本最大宽度为画面宽度的90%
-    draw_dummy = ImageDraw.Draw(Image.new("RGB", (1, 1)))
+@lru_cache(maxsize=None)
+def load_font(font_path, font_size):
+    """每种字体/字号只加载一次"""
+    return ImageFont.truetype(font_path, font_size)
 
-    def wrap_text(text, font, max_width):
-        lines = []
-        line = ""
-        for char in text:
-            if draw_dummy.textlength(line + char, font=font) <= max_width:
-                line += char
-            else:
-                lines.append(line)
-                line = char
-        lines.append(line)
-        return lines
+@lru_cache(maxsize=None)
+def glyph_width(font_path, font_size, char):
+    """缓存单字的前进宽度，换行时逐字累加即可，无需重复测量整行"""
+    return load_font(font_path, font_size).getlength(char)
+
+def wrap_text(text, font_path, font_size, max_width):
+    """按字宽累加自动换行，复杂度与文本长度成线性"""
+    lines = []
+    line = ""
+    line_width = 0.0
+    for char in text:
+        char_width = glyph_width(font_path, font_size, char)
+        if line_width + char_width <= max_width:
+            line += char
+            line_width += char_width
+        else:
+            lines.append(line)
+            line = char
+            line_width = char_width
+    lines.append(line)
+    return lines
+
+def subtitle_lines(text, width, font_path):
+    """字幕按画面宽度的 90% 自动换行后的各行"""
+    return wrap_text(text, font_path, SUBTITLE_FONT_SIZE, int(width * 0.9))
+
+def subtitle_image_height(text, img_size, font_path):
+    """render_subtitle_image 输出位图的高度（行数 × 行高 + 上下内边距），只换行不绘制"""
+    return int(len(subtitle_lines(text, img_size[0], font_path)) * (SUBTITLE_FONT_SIZE + SUBTITLE_LINE_SPACING) + 2 * SUBTITLE_PADDING)
 
-    lines = wrap_text(text, font, max_text_width)
-    line_height = font_size + 10
+@lru_cache(maxsize=512)
+def render_subtitle_image(text, img_size, font_path, bg_mode="dynamic"):
+    """
+    使用Pillow绘制自动换行、垂直居中的字幕，返回 RGBA 数组
+    结果按 (text, img_size, font_path, bg_mode) 缓存，返回的数组为只读
+    """
+    width, height = img_size
+    font_size = SUBTITLE_FONT_SIZE
+    font = load_font(font_path, font_size)
+
+    # 自动换行，文本最大宽度为画面宽度的90%
+    lines = subtitle_lines(text, width, font_path)
+    line_height = font_size + SUBTITLE_LINE_SPACING
     total_text_height = len(lines) * line_height
-    max_line_width = max(draw_dummy.textlength(line, font=font) for line in lines)
 
-    padding = 20
+    # 创建透明画布
+    draw_dummy = ImageDraw.Draw(Image.new("RGB", (1, 1)))
+    line_widths = [draw_dummy.textlength(line, font=font) for line in lines]
+    max_line_width = max(line_widths)
+
+    padding = SUBTITLE_PADDING
     bg_width = int(max_line_width + 2 * padding)
     bg_height = int(total_text_height + 2 * padding)
 
-    # 创建透明画布
     canvas = Image.new("RGBA", (bg_width, bg_height), (0, 0, 0, 0))
     draw = ImageDraw.Draw(canvas)
 
@@ -248,19 +912,57 @@ def create_subtitle_clip(text, duration, img_size, font_path, bg_mode="dynamic")
 
     # 绘制文字（垂直居中）
     y = padding
-    for line in lines:
-        line_width = draw.textlength(line, font=font)
+    for line, line_width in zip(lines, line_widths):
         x = (bg_width - line_width) // 2
         draw.text((x, y), line, font=font, fill="white")
         y += line_height
 
-    # 转换为 ImageClip
     np_img = np.array(canvas)
-    subtitle_clip = ImageClip(np_img, duration=duration)
-    subtitle_clip = subtitle_clip.with_duration(duration)
-    subtitle_clip = subtitle_clip.with_position(((img_size[0] - bg_width) // 2, img_size[1] - bg_height - 20))
-    subtitle_clip = subtitle_clip.with_effects([vfx.CrossFadeIn(0.3), vfx.CrossFadeOut(0.3)])
-    return subtitle_clip
+    np_img.flags.writeable = False
+    return np_img
+
+def subtitle_position(img_size, subtitle_size):
+    """字幕在画面中的左上角坐标：水平居中，距底部 SUBTITLE_BOTTOM_MARGIN"""
+    bg_height, bg_width = subtitle_size
+    return ((img_size[0] - bg_width) // 2, img_size[1] - bg_height - SUBTITLE_BOTTOM_MARGIN)
+
+class SubtitleTrack:
+    """
+    字幕轨道：按开始时间排序的区间索引
+    任意时刻只需二分查找即可得到正在显示的字幕（淡入淡出重叠时为两条），
+    透明度由预先算好的淡入结束、淡出开始时间直接求出，无需逐条字幕套用特效
+    """
+
+    def __init__(self, subtitles, fade=SUBTITLE_FADE):
+        self.subtitles = sorted((sub for sub in subtitles if sub["end"] > sub["start"]), key=lambda sub: sub["start"])
+        self.starts = [sub["start"] for sub in self.subtitles]
+        self.ends = [sub["end"] for sub in self.subtitles]
+        self.fade = fade
+        # 查询时只需回看最长字幕时长以内开始的字幕
+        self.max_duration = max((end - start for start, end in zip(self.starts, self.ends)), default=0.0)
+
+    def __len__(self):
+        return len(self.subtitles)
+
+    def active(self, t):
+        """返回 t 时刻正在显示的字幕序号（start <= t < end）"""
+        lo = bisect_left(self.starts, t - self.max_duration)
+        hi = bisect_right(self.starts, t)
+        return [idx for idx in range(lo, hi) if self.ends[idx] > t]
+
+    def alpha(self, idx, t):
+        """与 CrossFadeIn/CrossFadeOut 一致的透明度系数：moviepy 把两个遮罩渐变相乘，短于两倍渐变时长的字幕也一致"""
+        fade_in = (t - self.starts[idx]) / self.fade
+        fade_out = (self.ends[idx] - t) / self.fade
+        return max(0.0, min(1.0, fade_in)) * max(0.0, min(1.0, fade_out))
+
+    def overlays_at(self, t, frame_size, font_path, bg_mode, active=None):
+        """返回 t 时刻需要叠加的 [(rgba数组, (x, y), 透明度系数)]，可传入已查询好的 active 避免重复查找"""
+        overlays = []
+        for idx in self.active(t) if active is None else active:
+            rgba = render_subtitle_image(self.subtitles[idx]["text"], tuple(frame_size), font_path, bg_mode)
+            overlays.append((rgba, subtitle_position(frame_size, rgba.shape[:2]), self.alpha(idx, t)))
+        return overlays
 
 if __name__ == "__main__":
     import yaml
@@ -1,6 +1,6 @@
 import os
 import sys
-from gen_prompt import process_story_and_generate_prompts
+from gen_prompt import process_story_and_generate_prompts, iter_story_scene_prompts
 from gen_image import generate_images
 from gen_video import generate_video
 from subtitle import extract_subtitles
@@ -31,7 +31,7 @@ def main():
     output_dir = os.path.join(output_dir, story_name)
 
     load_dotenv(dotenv_path="config/key.zshrc", override=True)
-    llm_client = OpenAI(api_key=os.getenv("DEEPSEEK_API_KEY"), base_url="https://api.deepseek.com")
+    llm_client = OpenAI(api_key=os.getenv("DEEPSEEK_API_KEY"), base_url=config["model"]["llm"]["base_url"])
     
     
     # 1. 数据准备
@@ -43,11 +43,15 @@ def main():
     # 2. 提取字幕
     extract_subtitles(config, llm_client)
 
-    # 3. 生成提示词
-    process_story_and_generate_prompts(config, llm_client)
+    if config["model"]["llm"]["stream_prompts"]:
+        # 3 + 5. 流式生成提示词，每个场景的提示词一生成完就开始文生图
+        generate_images(config, iter_story_scene_prompts(config, llm_client))
+    else:
+        # 3. 生成提示词
+        process_story_and_generate_prompts(config, llm_client)
 
-    # 5. 文生图
-    generate_images(config)
+        # 5. 文生图
+        generate_images(config)
 
     # 6. 合成视频（调用 gen_video.py，传递参数）
     generate_video(config)
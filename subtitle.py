@@ -1,9 +1,13 @@
 import os
 import json
 import logging
-import time
-import whisper
+from concurrent.futures import ThreadPoolExecutor
+from asr_worker import transcribe_chunked, iter_transcribe_chunked, load_worker_authkey
 from utils.tools import safe_extract_json
+from utils.aligner import align_to_script, ScriptWindow
+from utils.batch_executor import BatchExecutor
+from utils.journal import AlignJournal
+from utils.llm_cache import open_llm_cache, cached_completion
 from utils.prompt import get_prompt
 
 def extract_subtitles(config, client):
@@ -18,6 +22,7 @@ def extract_subtitles(config, client):
     story_path = os.path.join(config["base"]["base_dir"], config["files"]["text"]["story"])
     subtitles_path = os.path.join(config["base"]["base_dir"], config["files"]["text"]["subtitles"])
     asr_result_path = os.path.join(config["base"]["base_dir"], config["files"]["text"]["asr_result"])
+    journal_path = os.path.join(config["base"]["base_dir"], config["files"]["text"]["align_journal"])
 
     model = config["model"]["asr"]["model"]
     if model == "whisper":
@@ -25,6 +30,11 @@ def extract_subtitles(config, client):
     else:
         raise ValueError("不支持的语音识别模型")
     align_batch_size = config["model"]["llm"]["align_batch_size"]
+    align_method = config["model"]["llm"]["align_method"]
+    align_min_confidence = config["model"]["llm"]["align_min_confidence"]
+    window_margin = config["model"]["llm"]["align_window_margin"]
+    executor = BatchExecutor.from_config(config["model"]["llm"])
+    cache = open_llm_cache(config)
 
     if os.path.exists(subtitles_path):
         with open(subtitles_path, "r", encoding="utf-8") as f:
@@ -32,40 +42,143 @@ def extract_subtitles(config, client):
         logging.info(f"字幕文件已存在，跳过字幕提取")
         return aligned_subtitles
     
+    asr_config = config["model"]["asr"]
+    worker_address = (asr_config["worker_host"], asr_config["worker_port"], load_worker_authkey(config["base"]["cache_dir"]))
+    # 追加式日志：记录每个已转写的音频块、识别结果与每个已完成的对齐批次，
+    # 中断后重新运行时只转写剩余的音频块，并从第一个未完成的批次继续
+    journal = AlignJournal(journal_path)
+    asr_result = None
     if os.path.exists(asr_result_path):
         with open(asr_result_path, "r", encoding="utf-8") as f:
             asr_result = json.load(f)
         logging.info(f"ASR结果文件已存在，跳过ASR,开始对齐")
+    elif journal.asr_segments is not None:
+        asr_result = journal.asr_segments
+        logging.info(f"从日志恢复ASR结果，跳过ASR,开始对齐")
+        with open(asr_result_path, "w", encoding="utf-8") as f:
+            json.dump(asr_result, f, ensure_ascii=False, indent=2)
+
+    if asr_result is not None:
+        aligned_subtitles = align_segments(client, asr_result, story_path, journal, executor, align_method, align_batch_size, align_min_confidence, window_margin, cache)
+    elif config["model"]["llm"]["stream_align"] and align_method == "llm":
+        # 流式：边识别边对齐，LLM 请求与语音识别重叠进行
+        logging.info("开始流式语音识别与对齐...")
+        segments = iter_transcribe_chunked(
+            audio_path, model, asr_config["workers"], asr_config["chunk_seconds"], asr_config["device"], worker_address,
+            done_chunks=journal.asr_chunks, on_chunk=journal.record_asr_chunk,
+        )
+        asr_result, aligned_subtitles = stream_align_segments(client, segments, story_path, journal, executor, batch_size=align_batch_size, window_margin=window_margin, cache=cache)
+        logging.info(f"语音识别完成，共识别出 {len(asr_result)} 个片段")
+        save_asr_result(asr_result, asr_result_path, journal)
     else:
         logging.info("开始语音识别...")
-        model = whisper.load_model(model)
-        result = model.transcribe(audio_path, temperature=0.6, language="zh")
-        segments = result["segments"]
+        # 与流式路径相同的分块转写：workers > 1 时多进程并行，否则交给常驻 ASR 服务（未运行时在进程内）
+        segments = transcribe_chunked(
+            audio_path, model, asr_config["workers"], asr_config["chunk_seconds"], asr_config["device"], worker_address,
+            done_chunks=journal.asr_chunks, on_chunk=journal.record_asr_chunk,
+        )
         logging.info(f"语音识别完成，共识别出 {len(segments)} 个片段")
-        asr_result = [
-            {
-                "text": seg["text"], #type: ignore
-                "start": round(seg["start"], 2), #type: ignore
-                "end": round(seg["end"], 2), #type: ignore
-                "duration": round(seg["end"] - seg["start"], 2) #type: ignore
-            } for seg in segments
-        ]
-        with open(asr_result_path, "w", encoding="utf-8") as f:
-            json.dump(asr_result, f, ensure_ascii=False, indent=2)
-    aligned_subtitles = align_segments_with_script_batched(client, asr_result, story_path, asr_result_path, batch_size=align_batch_size)
+        asr_result = [to_asr_entry(seg) for seg in segments]
+        save_asr_result(asr_result, asr_result_path, journal)
+        aligned_subtitles = align_segments(client, asr_result, story_path, journal, executor, align_method, align_batch_size, align_min_confidence, window_margin, cache)
     with open(subtitles_path, "w", encoding="utf-8") as f:
         json.dump(aligned_subtitles, f, ensure_ascii=False, indent=2)
     logging.info(f"字幕提取并对齐完成，输出到 {subtitles_path}")
+    if cache is not None:
+        cache.report("字幕对齐")
     return aligned_subtitles
 
-def align_segments_with_script_batched(client, asr_result, script_file, asr_result_path, batch_size = 8):
+def to_asr_entry(seg):
+    """Whisper segment -> asr_result.json 中的一条记录"""
+    return {
+        "text": seg["text"], #type: ignore
+        "start": round(seg["start"], 2), #type: ignore
+        "end": round(seg["end"], 2), #type: ignore
+        "duration": round(seg["end"] - seg["start"], 2) #type: ignore
+    }
+
+def save_asr_result(asr_result, asr_result_path, journal):
+    """识别结果写入 asr_result.json，并追加到日志"""
+    with open(asr_result_path, "w", encoding="utf-8") as f:
+        json.dump(asr_result, f, ensure_ascii=False, indent=2)
+    journal.record_asr(asr_result)
+
+def run_journaled_batches(executor, journal, kind, script, batches, func, fallback):
+    """
+    日志中已完成的批次直接复用结果，其余批次交给 executor，每完成一批立即追加到日志
+
+    Returns:
+        List[list]: 与 batches 一一对应的结果列表
+    """
+    keys = [AlignJournal.batch_key(script, batch) for batch in batches]
+    results = [journal.get_batch(kind, key) for key in keys]
+    pending = [i for i, result in enumerate(results) if result is None]
+    if len(pending) < len(batches):
+        logging.info(f"从日志恢复 {len(batches) - len(pending)} 个已完成的对齐批次，剩余 {len(pending)} 个")
+
+    def on_result(j, result):
+        journal.record_batch(kind, keys[pending[j]], result)
+
+    pending_results = executor.run([batches[i] for i in pending], func, fallback, on_result=on_result)
+    for i, result in zip(pending, pending_results):
+        results[i] = result
+    return results
+
+def align_segments(client, asr_result, script_file, journal, executor, align_method, batch_size, min_confidence, window_margin=0, cache=None):
+    """按配置选择对齐方式：llm 为逐批调用 LLM，local 为本地字符级对齐"""
+    if align_method == "llm":
+        return align_segments_with_script_batched(client, asr_result, script_file, journal, executor, batch_size=batch_size, window_margin=window_margin, cache=cache)
+    elif align_method == "local":
+        return align_segments_locally(client, asr_result, script_file, journal, executor, batch_size=batch_size, min_confidence=min_confidence, window_margin=window_margin, cache=cache)
+    else:
+        raise ValueError(f"不支持的对齐方式: {align_method}")
+
+def align_segments_locally(client, asr_result, script_file, journal, executor, batch_size=8, min_confidence=0.6, window_margin=0, cache=None):
+    """
+    本地确定性对齐：识别文本与剧本做带状字符级对齐后把剧本原文复制回每条字幕，
+    只有置信度低于 min_confidence 的片段才交给 LLM 重新对齐
+
+    Returns:
+        List[dict]: 对齐后的字幕数据
+    """
+    with open(script_file, "r", encoding="utf-8") as f:
+        script = f.read()
+
+    aligned_results, confidences = align_to_script(asr_result, script)
+    low = [i for i, confidence in enumerate(confidences) if confidence < min_confidence]
+    logging.info(f"本地对齐完成，共 {len(aligned_results)} 条字幕，其中 {len(low)} 条置信度低于 {min_confidence}")
+    if not low:
+        return aligned_results
+
+    system_prompt = get_prompt("align_subtitles")
+    windows = ScriptWindow(script, asr_result, window_margin, total_duration=asr_result[-1]["end"])
+    batches = [[asr_result[idx] for idx in low[i:i + batch_size]] for i in range(0, len(low), batch_size)]
+    # LLM 最终仍失败的片段返回 None，保留本地对齐结果
+    batch_results = run_journaled_batches(
+        executor, journal, "local", script, batches,
+        lambda batch: request_alignment(client, windows.window(batch), system_prompt, batch, cache),
+        lambda batch: [None] * len(batch),
+    )
+    windows.report()
+    llm_results = [item for batch_result in batch_results for item in batch_result]
+    for idx, item in zip(low, llm_results):
+        if item is not None:
+            aligned_results[idx]["text"] = item["text"]
+    return aligned_results
+
+def align_segments_with_script_batched(client, asr_result, script_file, journal, executor, batch_size = 8, window_margin=0, cache=None):
     """
     Whisper语音识别片段与剧本逐段匹配（batched处理，节省token）
+    各批次由 executor 并发、限速发送，失败的批次重试或拆分重试，结果按批次顺序拼接
 
     Args:
         asr_result: Whisper识别的语音片段列表
         script_file: 完整剧本路径
+        journal: AlignJournal，已完成的批次直接复用，新完成的批次立即追加
+        executor: BatchExecutor
         batch_size: 每次发送给 LLM 的片段数量
+        window_margin: 只发送本批在剧本中的估计区间及前后 window_margin 个字符，0 表示发送完整剧本
+        cache: LLMCache，为 None 时不使用缓存
 
     Returns:
         List[dict]: 对齐后的字幕数据
@@ -75,38 +188,85 @@ def align_segments_with_script_batched(client, asr_result, script_file, asr_resu
 
     system_prompt = get_prompt("align_subtitles")
 
-    aligned_results = []
+    batches = [asr_result[i:i + batch_size] for i in range(0, len(asr_result), batch_size)]
+    # 与流式路径相同，按此前识别文本的累计长度估计剧本窗口，两条路径的提示词与缓存键一致
+    windows = ScriptWindow(script, asr_result, window_margin)
+    batch_results = run_journaled_batches(
+        executor, journal, "llm", script, batches,
+        lambda batch: request_alignment(client, windows.window(batch), system_prompt, batch, cache),
+        keep_asr_text,
+    )
+    windows.report()
+    return [item for batch_result in batch_results for item in batch_result]
 
-    for i in range(0, len(asr_result), batch_size):
-        batch = asr_result[i:i + batch_size]
-        with open(asr_result_path, "w", encoding="utf-8") as f:
-            json.dump(batch, f, ensure_ascii=False, indent=2)
-
-        user_prompt = f"""剧本文本：
+def request_alignment(client, script, system_prompt, batch, cache=None):
+    """
+    将一个批次的识别句子发送给 LLM 与剧本对齐
+    返回内容为空、无法解析或条数与输入不一致时抛出异常，由 BatchExecutor 重试
+    """
+    user_prompt = f"""剧本文本：
 {script}
 
 识别句子列表：
 {json.dumps(batch, ensure_ascii=False, indent=2)}
 """
 
-        try:
-            response = client.chat.completions.create(
-                model="deepseek-chat",
-                messages=[
-                    {"role": "system", "content": system_prompt.strip()},
-                    {"role": "user", "content": user_prompt.strip()}
-                ],
-                temperature=0.2,
-            )
-            result = response.choices[0].message.content
-            if result is None:
-                raise ValueError("LLM 返回的内容为空")
-            batch_result = safe_extract_json(result)
-            aligned_results.extend(batch_result)
-            time.sleep(1.2)  # 防止触发速率限制
-        except Exception as e:
-            print(f"⚠️ 批次处理失败（第 {i//batch_size+1} 批）: {e}")
-            continue
+    def parse(content):
+        batch_result = safe_extract_json(content)
+        if len(batch_result) != len(batch):
+            raise ValueError(f"LLM 返回 {len(batch_result)} 条，输入为 {len(batch)} 条")
+        return batch_result
 
-    return aligned_results
+    return cached_completion(
+        client, cache, "align_subtitles",
+        [
+            {"role": "system", "content": system_prompt.strip()},
+            {"role": "user", "content": user_prompt.strip()}
+        ],
+        temperature=0.2,
+        parse=parse,
+    )
+
+def keep_asr_text(batch):
+    """对齐最终失败时保留识别原文，避免字幕出现空缺"""
+    return [dict(seg) for seg in batch]
+
+def stream_align_segments(client, segments, script_file, journal, executor, batch_size=8, window_margin=0, cache=None):
+    """
+    流式对齐：segments 为逐个产出的识别片段，每凑满 batch_size 条立即提交给 LLM，
+    LLM 请求与语音识别重叠进行。批次划分、剧本窗口（按此前识别文本的累计长度估计）、提示词、
+    限速与重试策略与批处理路径完全一致，结果按批次顺序拼接；识别结果相同时输出与批处理路径相同
+
+    Returns:
+        tuple: (asr_result, aligned_results)
+    """
+    with open(script_file, "r", encoding="utf-8") as f:
+        script = f.read()
+
+    system_prompt = get_prompt("align_subtitles")
+    asr_result = []
+    windows = ScriptWindow(script, asr_result, window_margin)
+
+    def align(batch):
+        return run_journaled_batches(
+            executor, journal, "llm", script, [batch],
+            lambda b: request_alignment(client, windows.window(b), system_prompt, b, cache),
+            keep_asr_text,
+        )[0]
+
+    futures = []
+    # 各批次在独立线程中运行，共用 executor 的令牌桶，并发数与批处理路径相同
+    with ThreadPoolExecutor(max_workers=executor.concurrency) as pool:
+        for seg in segments:
+            asr_result.append(to_asr_entry(seg))
+            if len(asr_result) % batch_size == 0:
+                futures.append(pool.submit(align, asr_result[-batch_size:]))
+        remainder = len(asr_result) % batch_size
+        if remainder:
+            futures.append(pool.submit(align, asr_result[-remainder:]))
 
+        aligned_results = []
+        for future in futures:
+            aligned_results.extend(future.result())
+    windows.report()
+    return asr_result, aligned_results
@@ -0,0 +1,387 @@
+import re
+import logging
+import threading
+from bisect import bisect_left
+from difflib import SequenceMatcher
+import numpy as np
+from utils.tools import ZH_NOISE_PATTERN, estimate_tokens, clean_zh_text
+
+DIAG, UP, LEFT = 0, 1, 2
+INF = 1 << 40
+# 剧本中出现这些标点的位置优先作为字幕分界
+BREAK_CHARS = set("。！？，；：…!?,;:\n")
+# 精确匹配种子的长度（清洗后的字符数），两边都只出现一次的片段才作为锚点
+SEED_CHARS = 6
+# 锚点之间的大间隙（如整段漏识别）用带状 DP 对齐时的固定带宽
+ALIGN_BAND = 100
+# 格子数不超过此值的小间隙直接逐格计算
+SMALL_GAP_CELLS = 4096
+
+def clean_with_offsets(text):
+    """
+    与 clean_zh_text 相同的清洗规则，同时返回清洗后每个字符在原文中的下标
+    """
+    kept = []
+    offsets = []
+    for idx, char in enumerate(text):
+        if not ZH_NOISE_PATTERN.fullmatch(char):
+            kept.append(char)
+            offsets.append(idx)
+    return "".join(kept), offsets
+
+def banded_alignment(a, b, band):
+    """
+    字符级带状编辑距离对齐（全局对齐），只计算对角线附近 band 宽度内的格子
+    每一行用 NumPy 向量化：对角/上方转移直接按数组计算，向左的转移用累积最小值一次求出
+
+    Returns:
+        List[tuple]: 从 (0, 0) 到 (len(a), len(b)) 的路径，每一步为 (i, j, move)
+    """
+    n, m = len(a), len(b)
+    # 相邻两行的带状区域必须相互衔接，带宽至少为每行对角线前进的列数
+    band = max(band, -(-m // max(n, 1)))
+    A = np.frombuffer(a.encode("utf-32-le"), dtype=np.uint32)
+    B = np.frombuffer(b.encode("utf-32-le"), dtype=np.uint32)
+    width = 2 * band + 1
+    offs = np.arange(width, dtype=np.int64)
+    # 第 i 行带状区域的起始列，沿全局对角线（长度比例）居中
+    lo = np.array([(i * m) // max(n, 1) - band for i in range(n + 1)], dtype=np.int64)
+    moves = np.full((n + 1, width), LEFT, dtype=np.uint8)
+
+    cols = lo[0] + offs
+    prev = np.where((cols >= 0) & (cols <= m), cols, INF)
+    for i in range(1, n + 1):
+        cols = lo[i] + offs
+        valid = (cols >= 0) & (cols <= m)
+        shift = lo[i] - lo[i - 1]
+
+        d_idx = offs + shift - 1
+        d_ok = (d_idx >= 0) & (d_idx < width) & (cols >= 1)
+        diag = np.where(d_ok, prev[np.clip(d_idx, 0, width - 1)], INF)
+        mismatch = B[np.clip(cols - 1, 0, max(m - 1, 0))] != A[i - 1] if m else np.ones(width, dtype=bool)
+        diag = diag + mismatch
+
+        u_idx = offs + shift
+        u_ok = (u_idx >= 0) & (u_idx < width)
+        up = np.where(u_ok, prev[np.clip(u_idx, 0, width - 1)], INF) + 1
+
+        best = np.minimum(diag, up)
+        best = np.where(valid, best, INF)
+        choice = np.where(diag <= up, DIAG, UP).astype(np.uint8)
+        # D[j] = min(best[j], D[j-1] + 1) 等价于 j + cummin(best[k] - k)
+        cur = offs + np.minimum.accumulate(best - offs)
+        choice = np.where(cur < best, LEFT, choice)
+        moves[i] = choice
+        prev = np.where(valid, cur, INF)
+
+    return _trace(moves, n, m, lo)
+
+def _trace(moves, n, m, lo=None):
+    """从 (n, m) 沿 moves 回溯到 (0, 0)；lo 为带状存储时每行的起始列"""
+    path = []
+    i, j = n, m
+    while i > 0 or j > 0:
+        move = (moves[i][j - lo[i]] if lo is not None else moves[i][j]) if i > 0 else LEFT
+        path.append((i, j, move))
+        if move == DIAG:
+            i, j = i - 1, j - 1
+        elif move == UP:
+            i -= 1
+        else:
+            j -= 1
+    path.append((0, 0, None))
+    path.reverse()
+    return path
+
+def full_alignment(a, b):
+    """逐格计算的编辑距离对齐，用于锚点之间的小间隙；转移的优先顺序与 banded_alignment 相同"""
+    n, m = len(a), len(b)
+    prev = list(range(m + 1))
+    moves = [[LEFT] * (m + 1)]
+    for i in range(1, n + 1):
+        char = a[i - 1]
+        cur = [i] + [0] * m
+        row = [UP] + [LEFT] * m
+        for j in range(1, m + 1):
+            diag = prev[j - 1] + (char != b[j - 1])
+            up = prev[j] + 1
+            best, move = (diag, DIAG) if diag <= up else (up, UP)
+            if cur[j - 1] + 1 < best:
+                best, move = cur[j - 1] + 1, LEFT
+            cur[j] = best
+            row[j] = move
+        moves.append(row)
+        prev = cur
+    return _trace(moves, n, m)
+
+def _unique_grams(text, k):
+    """text 中每个长度为 k 的片段首次出现的下标，出现多次的片段为 -1"""
+    grams = {}
+    for idx in range(len(text) - k + 1):
+        gram = text[idx:idx + k]
+        grams[gram] = -1 if gram in grams else idx
+    return grams
+
+def seed_anchors(a, b, k=SEED_CHARS):
+    """
+    以 a、b 中都只出现一次的 k 字片段为精确匹配种子，取 b 中位置递增的最长种子链（最长递增子序列），
+    合并为按顺序排列、互不重叠的匹配块
+
+    Returns:
+        List[tuple]: 每个匹配块为 (a 中起点, b 中起点, 长度)
+    """
+    grams_b = _unique_grams(b, k)
+    seeds = sorted((i, grams_b[gram]) for gram, i in _unique_grams(a, k).items() if i >= 0 and grams_b.get(gram, -1) >= 0)
+
+    tails, tail_seeds, parents = [], [], []
+    for s, (_, j) in enumerate(seeds):
+        pos = bisect_left(tails, j)
+        if pos == len(tails):
+            tails.append(j)
+            tail_seeds.append(s)
+        else:
+            tails[pos] = j
+            tail_seeds[pos] = s
+        parents.append(tail_seeds[pos - 1] if pos else -1)
+    chain = []
+    s = tail_seeds[-1] if tail_seeds else -1
+    while s >= 0:
+        chain.append(seeds[s])
+        s = parents[s]
+    chain.reverse()
+
+    blocks = []
+    end_a = end_b = 0
+    for i, j in chain:
+        if blocks and j - i == blocks[-1][1] - blocks[-1][0] and i <= end_a:
+            # 同一对角线上相互重叠的种子合并为一块
+            a0, b0, _ = blocks[-1]
+            blocks[-1] = (a0, b0, i + k - a0)
+        else:
+            skip = max(0, end_a - i, end_b - j)
+            if skip >= k:
+                continue
+            blocks.append((i + skip, j + skip, k - skip))
+        a0, b0, length = blocks[-1]
+        end_a, end_b = a0 + length, b0 + length
+    return blocks
+
+def anchored_alignment(a, b, band=ALIGN_BAND):
+    """
+    字符级编辑距离对齐（全局对齐）：seed_anchors 找出的精确匹配块按对角线直接匹配，
+    只对相邻匹配块之间的间隙求对齐，小间隙逐格计算，大间隙用固定带宽 band 的 banded_alignment；
+    耗时与内存随文本长度近似线性增长
+
+    Returns:
+        List[tuple]: 从 (0, 0) 到 (len(a), len(b)) 的路径，每一步为 (i, j, move)
+    """
+    path = [(0, 0, None)]
+    start_a = start_b = 0
+    for a0, b0, length in seed_anchors(a, b) + [(len(a), len(b), 0)]:
+        gap_a, gap_b = a[start_a:a0], b[start_b:b0]
+        if (len(gap_a) + 1) * (len(gap_b) + 1) <= SMALL_GAP_CELLS:
+            gap_path = full_alignment(gap_a, gap_b)
+        else:
+            gap_path = banded_alignment(gap_a, gap_b, band)
+        path.extend((start_a + i, start_b + j, move) for i, j, move in gap_path[1:])
+        path.extend((a0 + t, b0 + t, DIAG) for t in range(1, length + 1))
+        start_a, start_b = a0 + length, b0 + length
+    return path
+
+def _segment_cuts(seg_texts, story, script, offsets, band=None):
+    """
+    把按顺序排列的若干段文本（已清洗）拼接后与清洗后的 story 对齐，求每段在 story 中的起止位置
+
+    Returns:
+        tuple: (cuts, matched, bounds)
+            cuts: 长度为段数 + 1，第 k 段对应 story[cuts[k]:cuts[k + 1]]
+            matched: 拼接文本中每个字符是否与 story 中的字符相同
+            bounds: 拼接文本中每段的起止下标
+    """
+    joined = "".join(seg_texts)
+    n, m = len(joined), len(story)
+
+    bounds = np.cumsum([0] + [len(text) for text in seg_texts])
+    path = anchored_alignment(joined, story, band or ALIGN_BAND)
+
+    # 每一行在路径上的列范围，以及每个字符是否与 story 字符相同
+    row_min = np.full(n + 1, m, dtype=np.int64)
+    row_max = np.zeros(n + 1, dtype=np.int64)
+    matched = np.zeros(n, dtype=bool)
+    for i, j, move in path:
+        row_min[i] = min(row_min[i], j)
+        row_max[i] = max(row_max[i], j)
+        if move == DIAG and joined[i - 1] == story[j - 1]:
+            matched[i - 1] = True
+
+    # story 第 j 个清洗字符之前的原文间隙中是否有断句标点
+    has_break = np.zeros(m + 1, dtype=bool)
+    for j in range(1, m):
+        gap = script[offsets[j - 1] + 1:offsets[j]]
+        has_break[j] = any(char in BREAK_CHARS for char in gap)
+
+    # 段落分界处若路径横向跨过多个 story 字符（漏识别），优先在标点处切分
+    cuts = []
+    for p in bounds:
+        lo, hi = int(row_min[p]), int(row_max[p])
+        cut = next((j for j in range(lo, hi + 1) if has_break[j]), lo)
+        cuts.append(cut)
+    cuts[0], cuts[-1] = 0, m
+    return cuts, matched, bounds
+
+def split_points(seg_texts, script, band=None):
+    """
+    将 seg_texts（如 LLM 加了分隔符后返回的原文片段，可能有少量改动）映射回 script 原文的切分位置：
+    切分点落在两段之间的标点之后，句末标点归前一段、开引号等归后一段
+
+    Returns:
+        List[int]: 长度为段数 + 1 的原文下标，第 k 段对应 script[points[k]:points[k + 1]]
+    """
+    story, offsets = clean_with_offsets(script)
+    cleaned = [clean_with_offsets(text)[0] for text in seg_texts]
+    cuts, _, _ = _segment_cuts(cleaned, story, script, offsets, band)
+
+    points = []
+    for cut in cuts:
+        if cut <= 0:
+            points.append(0)
+        elif cut >= len(story):
+            points.append(len(script))
+        else:
+            gap_start = offsets[cut - 1] + 1
+            gap = script[gap_start:offsets[cut]]
+            last_break = max((k for k, char in enumerate(gap) if char in BREAK_CHARS or char.isspace()), default=None)
+            points.append(gap_start + last_break + 1 if last_break is not None else offsets[cut])
+    points[0], points[-1] = 0, len(script)
+    return points
+
+def align_to_script(asr_result, script, band=None):
+    """
+    本地确定性对齐：把所有识别句子拼接后与清洗后的剧本做字符级对齐，
+    再把每个识别句子对应的剧本原文（含标点）复制回 text 字段，start/end/duration 保持不变
+
+    Returns:
+        tuple: (对齐后的字幕列表, 每条字幕的置信度列表)
+    """
+    story, offsets = clean_with_offsets(script)
+    seg_texts = [clean_with_offsets(seg["text"])[0] for seg in asr_result]
+    m = len(story)
+    cuts, matched, bounds = _segment_cuts(seg_texts, story, script, offsets, band)
+
+    aligned = []
+    confidences = []
+    for k, seg in enumerate(asr_result):
+        s, e = cuts[k], cuts[k + 1]
+        orig_start = offsets[s] if s < m else len(script)
+        orig_end = offsets[e] if e < m else len(script)
+        text = re.sub(r"\s*\n\s*", "", script[orig_start:orig_end]).strip()
+        seg_len = int(bounds[k + 1] - bounds[k])
+        hits = int(matched[bounds[k]:bounds[k + 1]].sum())
+        confidence = hits / max(seg_len, e - s) if text else 0.0
+        aligned.append({
+            "text": text if text else seg["text"],
+            "start": seg["start"],
+            "end": seg["end"],
+            "duration": seg["duration"],
+        })
+        confidences.append(confidence)
+    return aligned, confidences
+
+class ScriptWindow:
+    """
+    为每个对齐批次估计其在剧本中的位置，只截取该区间加上前后 margin 个字符发送给 LLM：
+    起点优先用上一条识别句子在剧本中的模糊锚点，找不到时按时间戳占总时长的比例估计；
+    终点取本批最后一句的锚点、时间比例估计与“起点 + 本批识别文本长度”中的最大值。
+    segments 可以是仍在增长的列表（流式对齐），total_duration 为 None 时改用此前识别文本的累计长度估计位置。
+    margin <= 0 时始终返回完整剧本
+    """
+    def __init__(self, script, segments, margin, total_duration=None):
+        self.script = script
+        self.story, self.offsets = clean_with_offsets(script)
+        self.segments = segments
+        self.margin = margin
+        self.total_duration = total_duration
+        self.full_tokens = estimate_tokens(script)
+        self.requests = 0
+        self.sent_tokens = 0
+        self._lock = threading.Lock()
+        # _lengths[k] 为前 k 句识别文本清洗后的累计长度，_indices 为 id(片段) 到下标的映射，随 segments 增长追加
+        self._lengths = [0]
+        self._indices = {}
+
+    def _sync(self):
+        """把 segments 中新增的片段（流式对齐时列表仍在增长）追加到累计长度与下标表，调用方需持有 _lock"""
+        for idx in range(len(self._lengths) - 1, len(self.segments)):
+            seg = self.segments[idx]
+            self._indices[id(seg)] = idx
+            self._lengths.append(self._lengths[-1] + len(clean_zh_text(seg["text"])))
+
+    def _index_of(self, batch):
+        with self._lock:
+            idx = self._indices.get(id(batch[0]))
+            if idx is None:
+                self._sync()
+                idx = self._indices.get(id(batch[0]))
+        if idx is None:
+            raise ValueError("批次不在识别结果中")
+        return idx
+
+    def _estimate_position(self, idx, seconds):
+        """按时间占比估计剧本位置；总时长未知时用前 idx 句识别文本的累计长度估计"""
+        if self.total_duration:
+            return int(len(self.story) * min(max(seconds / self.total_duration, 0.0), 1.0))
+        return min(len(self.story), self._lengths[idx])
+
+    def _find_anchor(self, text, around):
+        """在 around 附近模糊查找 text，返回其结尾在清洗后剧本中的下标"""
+        query = clean_with_offsets(text)[0]
+        if not query:
+            return None
+        radius = max(2 * self.margin, len(self.story) // 10)
+        lo, hi = max(0, around - radius), min(len(self.story), around + radius)
+        match = SequenceMatcher(None, query, self.story[lo:hi], autojunk=False).find_longest_match(0, len(query), 0, hi - lo)
+        if match.size < max(2, len(query) // 3):
+            return None
+        return min(len(self.story), lo + match.b + len(query) - match.a)
+
+    def window(self, batch):
+        """返回发送给 LLM 的剧本片段（原文，含标点），并累计窗口化前后的 token 估计"""
+        text = self.script
+        if self.margin > 0 and self.story:
+            idx = self._index_of(batch)
+            batch_len = sum(len(clean_zh_text(seg["text"])) for seg in batch)
+            est_start = self._estimate_position(idx, batch[0]["start"])
+            est_end = self._estimate_position(idx, batch[-1]["end"]) if self.total_duration else est_start + batch_len
+
+            start = None
+            if idx > 0:
+                start = self._find_anchor(self.segments[idx - 1]["text"], est_start)
+            if start is None:
+                start = est_start
+            ends = [start + batch_len, est_end]
+            anchor_end = self._find_anchor(batch[-1]["text"], est_end)
+            if anchor_end is not None:
+                ends.append(anchor_end)
+
+            lo = max(0, start - self.margin)
+            hi = min(len(self.story), max(ends) + self.margin)
+            if lo > 0 or hi < len(self.story):
+                orig_start = self.offsets[lo] if lo > 0 else 0
+                orig_end = self.offsets[hi] if hi < len(self.story) else len(self.script)
+                text = self.script[orig_start:orig_end]
+
+        with self._lock:
+            self.requests += 1
+            self.sent_tokens += estimate_tokens(text)
+        return text
+
+    def report(self):
+        """输出本次运行中剧本部分的提示词 token 节省情况"""
+        if not self.requests:
+            return
+        full = self.full_tokens * self.requests
+        saved = full - self.sent_tokens
+        logging.info(
+            f"剧本窗口化：{self.requests} 次对齐请求中剧本部分约 {self.sent_tokens} tokens，"
+            f"发送完整剧本约需 {full} tokens，节省约 {saved} tokens（{saved / max(full, 1):.0%}）"
+        )
@@ -0,0 +1,115 @@
+import time
+import random
+import asyncio
+import logging
+import threading
+
+class TokenBucket:
+    """
+    令牌桶限速器：每秒补充 rate 个令牌，最多累积 capacity 个（允许的突发请求数）
+    采用预订方式计算等待时间，线程安全，可同时用于 asyncio 协程与线程池；rate <= 0 表示不限速
+    """
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = capacity if capacity is not None else max(1.0, rate)
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _reserve(self):
+        """取走一个令牌（可以透支），返回令牌实际可用前需要等待的秒数"""
+        if self.rate <= 0:
+            return 0.0
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+            self._tokens -= 1
+            return max(0.0, -self._tokens / self.rate)
+
+    async def acquire(self):
+        delay = self._reserve()
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+    def acquire_sync(self):
+        delay = self._reserve()
+        if delay > 0:
+            time.sleep(delay)
+
+class SplitBatch(Exception):
+    """批次过大（如响应被截断）时由 func 抛出，执行器不再原样重试，直接拆成两半"""
+
+class BatchExecutor:
+    """
+    并发批处理执行器：以 concurrency 为上限并发调用同步函数 func(batch)（在线程中运行），
+    每次请求前从令牌桶取令牌，失败后指数退避重试 max_retries 次；
+    仍失败的批次拆成两半分别重试，拆到单条仍失败时交给 fallback（未提供则抛出异常）；
+    func 抛出 SplitBatch 时（多于一条的批次）跳过重试立即拆半。
+    func 与 fallback 都需返回列表，结果按批次顺序拼接；on_result(批次下标, 结果) 在每个批次完成时立即调用
+    """
+    def __init__(self, concurrency=4, requests_per_second=2.0, max_retries=3, base_delay=1.0, max_delay=30.0):
+        self.concurrency = max(1, concurrency)
+        self.limiter = TokenBucket(requests_per_second)
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+
+    @classmethod
+    def from_config(cls, llm_config):
+        return cls(
+            concurrency=llm_config["concurrency"],
+            requests_per_second=llm_config["requests_per_second"],
+            max_retries=llm_config["max_retries"],
+        )
+
+    async def call_with_retry(self, func, batch, label):
+        for attempt in range(self.max_retries + 1):
+            await self.limiter.acquire()
+            try:
+                return await asyncio.to_thread(func, batch)
+            except Exception as e:
+                if attempt == self.max_retries or (isinstance(e, SplitBatch) and len(batch) > 1):
+                    raise
+                # 指数退避并加随机抖动，避免并发请求同时重试
+                delay = min(self.max_delay, self.base_delay * 2 ** attempt) * random.uniform(0.5, 1.0)
+                logging.warning(f"批次 {label} 第 {attempt + 1} 次请求失败，{delay:.1f} 秒后重试: {e}")
+                await asyncio.sleep(delay)
+
+    async def run_async(self, batches, func, fallback=None, on_result=None):
+        semaphore = asyncio.Semaphore(self.concurrency)
+
+        async def run(batch, label):
+            try:
+                async with semaphore:
+                    return await self.call_with_retry(func, batch, label)
+            except Exception as e:
+                if len(batch) > 1:
+                    if isinstance(e, SplitBatch):
+                        logging.warning(f"批次 {label} 过大，拆分为两半重试: {e}")
+                    else:
+                        logging.warning(f"批次 {label} 重试 {self.max_retries} 次后仍失败，拆分为两半重试: {e}")
+                    mid = len(batch) // 2
+                    left, right = await asyncio.gather(run(batch[:mid], f"{label}a"), run(batch[mid:], f"{label}b"))
+                    return left + right
+                if fallback is None:
+                    raise
+                logging.error(f"批次 {label} 拆分到单条后仍失败，使用回退结果: {e}")
+                return fallback(batch)
+
+        async def run_batch(i, batch):
+            result = await run(batch, str(i + 1))
+            if on_result is not None:
+                on_result(i, result)
+            return result
+
+        return await asyncio.gather(*(run_batch(i, batch) for i, batch in enumerate(batches)))
+
+    def run(self, batches, func, fallback=None, on_result=None):
+        """
+        同步入口，在新的事件循环中执行全部批次
+
+        Returns:
+            List[list]: 与 batches 一一对应的结果列表
+        """
+        return asyncio.run(self.run_async(batches, func, fallback, on_result))
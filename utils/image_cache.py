@@ -0,0 +1,74 @@
+import os
+import hashlib
+import logging
+import numpy as np
+from PIL import Image # type: ignore
+
+def file_digest(path, chunk_size=1 << 20):
+    """计算文件内容的 sha256，用作缓存键"""
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+def prepare_scene_image(img_path, frame_size, cache_dir):
+    """
+    将场景图片解码并缩放到 frame_size，以 uint8 原始数组（.npy）存入缓存目录
+    缓存键为图片内容哈希 + 目标尺寸，图片不变时直接复用
+
+    Returns:
+        str: 缓存文件路径
+    """
+    width, height = frame_size
+    cache_path = os.path.join(cache_dir, f"{file_digest(img_path)}_{width}x{height}.npy")
+    if os.path.exists(cache_path):
+        # 显式更新访问时间，文件系统以 noatime/relatime 挂载时淘汰顺序仍然正确
+        os.utime(cache_path)
+        return cache_path
+
+    with Image.open(img_path) as img:
+        # reducing_gap 先做整数倍盒式缩小，再用 LANCZOS 精缩，大图缩小时快得多
+        img = img.convert("RGB").resize(frame_size, Image.Resampling.LANCZOS, reducing_gap=3.0)
+        tmp_path = f"{cache_path}.{os.getpid()}.tmp"
+        arr = np.lib.format.open_memmap(tmp_path, mode="w+", dtype=np.uint8, shape=(height, width, 3))
+        arr[:] = np.asarray(img)
+        arr.flush()
+        del arr
+    os.replace(tmp_path, cache_path)
+    return cache_path
+
+def prepare_scene_images(img_paths, frame_size, cache_dir):
+    """批量预处理场景图片，返回与输入顺序一致的缓存路径列表"""
+    os.makedirs(cache_dir, exist_ok=True)
+    cache_paths = [prepare_scene_image(img_path, frame_size, cache_dir) for img_path in img_paths]
+    logging.info(f"场景图片预处理完成，共 {len(cache_paths)} 张，缓存目录: {cache_dir}")
+    return cache_paths
+
+def evict_scene_images(cache_dir, max_bytes):
+    """缓存目录中的 .npy 总大小超过 max_bytes 时，按访问时间从旧到新删除，直到不超过上限"""
+    if not os.path.isdir(cache_dir):
+        return
+    entries = []
+    for entry in os.scandir(cache_dir):
+        if entry.name.endswith(".npy") and entry.is_file():
+            stat = entry.stat()
+            entries.append((stat.st_atime, stat.st_size, entry.path))
+    total = sum(size for _, size, _ in entries)
+    if total <= max_bytes:
+        return
+    evicted = 0
+    for _, size, path in sorted(entries):
+        if total <= max_bytes:
+            break
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+        total -= size
+        evicted += 1
+    logging.info(f"场景图片缓存超过 {max_bytes} 字节，淘汰最久未使用的 {evicted} 个文件")
+
+def load_scene_image(cache_path):
+    """以内存映射方式读取预处理好的场景图片，只在访问时才占用内存"""
+    return np.load(cache_path, mmap_mode="r")
@@ -0,0 +1,80 @@
+import os
+import json
+import hashlib
+import logging
+import threading
+
+class AlignJournal:
+    """
+    字幕提取的追加式日志（JSONL），每行一条记录，写入后立即 fsync：
+        {"type": "asr_chunk", "span": [start, end], "segments": [...]}  一个已转写的音频块（采样点区间）
+        {"type": "asr", "segments": [...]}                         完整的识别结果
+        {"type": "batch", "kind": "llm", "key": ..., "result": [...]}  一个已完成的对齐批次
+    音频块转写完成后立即记录，识别中途崩溃时重启只转写剩余的块；Whisper 以采样方式解码，
+    复用已记录的块才能得到相同的识别结果，从而使已完成批次的哈希保持一致。
+    批次以 key（剧本内容 + 批次输入的哈希）标识，重启后识别结果或剧本不变的批次直接复用，
+    只有哈希一致的批次才会被跳过。进程在写入中途崩溃时，末尾不完整的一行在读取时被截掉
+    """
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self.asr_segments = None
+        self.asr_chunks = {}
+        self.batches = {}
+        if os.path.exists(path):
+            self._load()
+
+    def _load(self):
+        with open(self.path, "rb") as f:
+            data = f.read()
+        # 截掉崩溃时写了一半的末行，避免后续追加的记录与其拼在同一行
+        valid = data.rfind(b"\n") + 1
+        if valid < len(data):
+            logging.warning(f"截断日志 {self.path} 末尾不完整的记录")
+            with open(self.path, "r+b") as f:
+                f.truncate(valid)
+        for line in data[:valid].decode("utf-8").splitlines():
+            try:
+                entry = json.loads(line)
+            except json.JSONDecodeError:
+                logging.warning(f"忽略日志 {self.path} 中无法解析的记录")
+                continue
+            if entry["type"] == "asr_chunk":
+                self.asr_chunks[tuple(entry["span"])] = entry["segments"]
+            elif entry["type"] == "asr":
+                self.asr_segments = entry["segments"]
+            elif entry["type"] == "batch":
+                self.batches[(entry["kind"], entry["key"])] = entry["result"]
+        logging.info(f"读取日志 {self.path}：识别结果{'已' if self.asr_segments is not None else '未'}完成（已转写 {len(self.asr_chunks)} 个音频块），已完成 {len(self.batches)} 个对齐批次")
+
+    def _append(self, entry):
+        line = json.dumps(entry, ensure_ascii=False) + "\n"
+        with self._lock:
+            with open(self.path, "a", encoding="utf-8") as f:
+                f.write(line)
+                f.flush()
+                os.fsync(f.fileno())
+
+    @staticmethod
+    def batch_key(script, batch):
+        content = json.dumps({"script": script, "batch": batch}, ensure_ascii=False, sort_keys=True)
+        return hashlib.sha256(content.encode("utf-8")).hexdigest()
+
+    def record_asr_chunk(self, span, segments):
+        """记录一个音频块的识别结果，只保留对齐所需的字段（未取整的时间戳，恢复后转换结果不变）"""
+        span = (int(span[0]), int(span[1]))
+        segments = [{"text": seg["text"], "start": float(seg["start"]), "end": float(seg["end"])} for seg in segments]
+        self.asr_chunks[span] = segments
+        self._append({"type": "asr_chunk", "span": list(span), "segments": segments})
+
+    def record_asr(self, segments):
+        self.asr_segments = segments
+        self._append({"type": "asr", "segments": segments})
+
+    def get_batch(self, kind, key):
+        """返回已完成批次的结果，未完成时返回 None"""
+        return self.batches.get((kind, key))
+
+    def record_batch(self, kind, key, result):
+        self.batches[(kind, key)] = result
+        self._append({"type": "batch", "kind": kind, "key": key, "result": result})
@@ -0,0 +1,94 @@
+import json
+
+class TruncatedJSONError(ValueError):
+    """文本已结束但 JSON 数组仍未闭合"""
+
+class JSONArrayParser:
+    """
+    增量解析 JSON 数组：逐段输入文本，每当数组中的一个元素完整出现时立即解析并返回
+    第一个 [ 之前的内容（如说明文字、```json 标记）被忽略，数组的 ] 之后的内容也被忽略；
+    通过跟踪字符串与转义状态计算嵌套深度，字符串中的括号不影响元素边界
+    """
+    def __init__(self):
+        self.started = False
+        self.done = False
+        self.depth = 0
+        self.in_string = False
+        self.escape = False
+        self.element = []
+
+    def feed(self, text):
+        """
+        输入一段文本
+
+        Returns:
+            list: 本段文本中新完成的数组元素
+        """
+        items = []
+        for char in text:
+            if self.done:
+                break
+            if not self.started:
+                self.started = char == "["
+                continue
+            if self.in_string:
+                self.element.append(char)
+                if self.escape:
+                    self.escape = False
+                elif char == "\\":
+                    self.escape = True
+                elif char == '"':
+                    self.in_string = False
+                continue
+            if self.depth == 0:
+                # 数组层级：逗号与 ] 分隔元素，元素之间的空白跳过
+                if char == "," or char == "]":
+                    self._flush(items)
+                    self.done = char == "]"
+                    continue
+                if char.isspace() and not self.element:
+                    continue
+            self.element.append(char)
+            if char == '"':
+                self.in_string = True
+            elif char == "{" or char == "[":
+                self.depth += 1
+            elif char == "}" or char == "]":
+                self.depth -= 1
+                if self.depth == 0:
+                    self._flush(items)
+        return items
+
+    def _flush(self, items):
+        text = "".join(self.element).strip()
+        self.element = []
+        if text:
+            items.append(json.loads(text))
+
+def iter_json_array(chunks):
+    """
+    从逐段到达的文本（如流式 LLM 响应）中解析 JSON 数组，每个元素完整后立即产出
+    文本结束时数组仍未闭合（响应被截断）则抛出 TruncatedJSONError，已产出的元素不受影响
+    """
+    parser = JSONArrayParser()
+    for chunk in chunks:
+        yield from parser.feed(chunk)
+    if not parser.done:
+        raise TruncatedJSONError("JSON 数组不完整，响应可能被截断")
+
+def parse_json_array(content):
+    """
+    从完整文本中解析第一个由对象组成的非空 JSON 数组；某个 [ 处解析失败，或得到空数组、
+    含非对象元素的数组（如说明文字中的 [] 或 [1, 2]）时，从下一个 [ 重新尝试
+    """
+    start = content.find("[")
+    while start != -1:
+        parser = JSONArrayParser()
+        try:
+            items = parser.feed(content[start:])
+            if parser.done and items and all(isinstance(item, dict) for item in items):
+                return items
+        except json.JSONDecodeError:
+            pass
+        start = content.find("[", start + 1)
+    return None
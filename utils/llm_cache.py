@@ -0,0 +1,166 @@
+import os
+import json
+import time
+import sqlite3
+import hashlib
+import logging
+import threading
+from utils.prompt import PROMPT_VERSION
+
+class LLMCache:
+    """
+    持久化的 LLM 响应缓存（SQLite），跨运行、跨故事复用
+    键为 (模型, messages, temperature, 提示词模板版本) 的哈希；总大小超过 max_bytes 时按最近使用时间淘汰
+    """
+    def __init__(self, path, max_bytes):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        with self._conn:
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS responses ("
+                "key TEXT PRIMARY KEY, response TEXT NOT NULL, size INTEGER NOT NULL, last_used REAL NOT NULL)"
+            )
+            self._conn.execute("CREATE INDEX IF NOT EXISTS idx_last_used ON responses (last_used)")
+
+    @staticmethod
+    def make_key(model, messages, temperature, template):
+        content = json.dumps(
+            {"model": model, "messages": messages, "temperature": temperature, "template": template, "version": PROMPT_VERSION},
+            ensure_ascii=False, sort_keys=True,
+        )
+        return hashlib.sha256(content.encode("utf-8")).hexdigest()
+
+    def get(self, key):
+        with self._lock:
+            row = self._conn.execute("SELECT response FROM responses WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            with self._conn:
+                self._conn.execute("UPDATE responses SET last_used = ? WHERE key = ?", (time.time(), key))
+            return row[0]
+
+    def put(self, key, response):
+        size = len(response.encode("utf-8"))
+        with self._lock, self._conn:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO responses (key, response, size, last_used) VALUES (?, ?, ?, ?)",
+                (key, response, size, time.time()),
+            )
+            self._evict()
+
+    def delete(self, key):
+        with self._lock, self._conn:
+            self._conn.execute("DELETE FROM responses WHERE key = ?", (key,))
+
+    def _evict(self):
+        total = self._conn.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+        if total <= self.max_bytes:
+            return
+        evicted = []
+        for key, size in self._conn.execute("SELECT key, size FROM responses ORDER BY last_used"):
+            if total <= self.max_bytes:
+                break
+            evicted.append((key,))
+            total -= size
+        self._conn.executemany("DELETE FROM responses WHERE key = ?", evicted)
+        logging.info(f"LLM 缓存超过 {self.max_bytes} 字节，淘汰最久未使用的 {len(evicted)} 条")
+
+    def report(self, stage):
+        total = self.hits + self.misses
+        if total:
+            logging.info(f"LLM 缓存（{stage}）：命中 {self.hits} 次，未命中 {self.misses} 次，命中率 {self.hits / total:.0%}")
+        self.hits = 0
+        self.misses = 0
+
+_caches = {}
+
+def open_llm_cache(config):
+    """按配置打开 LLM 缓存，同一进程内复用同一个实例；model.llm.cache_max_mb 为 0 时不使用缓存"""
+    max_mb = config["model"]["llm"]["cache_max_mb"]
+    if not max_mb:
+        return None
+    path = os.path.join(config["base"]["cache_dir"], "llm_cache.sqlite")
+    if path not in _caches:
+        _caches[path] = LLMCache(path, int(max_mb * 1024 * 1024))
+    return _caches[path]
+
+def cached_completion(client, cache, template, messages, temperature, parse=lambda content: content, model="deepseek-chat", **kwargs):
+    """
+    带缓存的 chat.completions 调用：命中时直接解析缓存内容，否则调用 LLM
+    只有 parse 成功（返回内容有效）的响应才会写入缓存，避免重试时反复命中同一个无效结果
+
+    Returns:
+        parse(响应文本) 的结果
+    """
+    key = LLMCache.make_key(model, messages, temperature, template) if cache is not None else None
+    if cache is not None:
+        content = cache.get(key)
+        if content is not None:
+            try:
+                return parse(content)
+            except Exception:
+                cache.delete(key)
+
+    response = client.chat.completions.create(model=model, messages=messages, temperature=temperature, **kwargs)
+    content = response.choices[0].message.content
+    if content is None:
+        raise ValueError("LLM 返回的内容为空")
+    result = parse(content)
+    if cache is not None:
+        cache.put(key, content)
+    return result
+
+class CompletionStream:
+    """
+    带缓存的流式 chat.completions：迭代时逐段产出响应文本，命中缓存时一次性产出缓存内容
+    调用方校验完整响应后调用 commit() 写入缓存，校验失败时调用 discard() 删除可能存在的缓存项；
+    迭代结束后 finish_reason 为 "length" 表示响应因输出长度上限被截断
+    """
+    def __init__(self, client, cache, template, messages, temperature, model="deepseek-chat", **kwargs):
+        self.client = client
+        self.cache = cache
+        self.messages = messages
+        self.temperature = temperature
+        self.model = model
+        self.kwargs = kwargs
+        self.finish_reason = None
+        self.key = LLMCache.make_key(model, messages, temperature, template) if cache is not None else None
+        self.parts = []
+        self.from_cache = False
+
+    def __iter__(self):
+        self.parts = []
+        self.finish_reason = None
+        cached = self.cache.get(self.key) if self.cache is not None else None
+        if cached is not None:
+            self.from_cache = True
+            self.parts.append(cached)
+            yield cached
+            return
+        response = self.client.chat.completions.create(
+            model=self.model, messages=self.messages, temperature=self.temperature, stream=True, **self.kwargs
+        )
+        for chunk in response:
+            if not chunk.choices:
+                continue
+            if chunk.choices[0].finish_reason:
+                self.finish_reason = chunk.choices[0].finish_reason
+            delta = chunk.choices[0].delta.content
+            if delta:
+                self.parts.append(delta)
+                yield delta
+
+    def commit(self):
+        if self.cache is not None and not self.from_cache:
+            self.cache.put(self.key, "".join(self.parts))
+
+    def discard(self):
+        if self.cache is not None and self.from_cache:
+            self.cache.delete(self.key)
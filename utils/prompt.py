@@ -1,3 +1,6 @@
+# 提示词模板版本：修改任一模板或其输出的解析方式时递增，使 LLM 缓存中的旧响应失效
+PROMPT_VERSION = 1
+
 def get_prompt(type: str) -> str:
     if type == "split_raw_story":
         prompt = """
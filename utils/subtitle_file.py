@@ -0,0 +1,83 @@
+import os
+import logging
+
+def format_srt_time(seconds: float) -> str:
+    """秒 -> SRT 时间格式 HH:MM:SS,mmm"""
+    ms = int(round(max(seconds, 0.0) * 1000))
+    h, ms = divmod(ms, 3600_000)
+    m, ms = divmod(ms, 60_000)
+    s, ms = divmod(ms, 1000)
+    return f"{h:02d}:{m:02d}:{s:02d},{ms:03d}"
+
+def format_ass_time(seconds: float) -> str:
+    """秒 -> ASS 时间格式 H:MM:SS.cc"""
+    cs = int(round(max(seconds, 0.0) * 100))
+    h, cs = divmod(cs, 360_000)
+    m, cs = divmod(cs, 6000)
+    s, cs = divmod(cs, 100)
+    return f"{h:d}:{m:02d}:{s:02d}.{cs:02d}"
+
+def write_srt(subtitles, srt_path):
+    """将对齐后的字幕写为 SRT 文件"""
+    lines = []
+    for idx, sub in enumerate(subtitles, start=1):
+        lines.append(str(idx))
+        lines.append(f"{format_srt_time(sub['start'])} --> {format_srt_time(sub['end'])}")
+        lines.append(sub["text"].strip())
+        lines.append("")
+    with open(srt_path, "w", encoding="utf-8") as f:
+        f.write("\n".join(lines))
+    logging.info(f"SRT 字幕已保存到 {srt_path}")
+
+def write_ass(subtitles, ass_path, frame_size, font_name, font_size=30, bottom_margin=40, box_padding=10, bg_mode="dynamic", fade=0.3):
+    """
+    将对齐后的字幕写为 ASS 文件，样式与 Pillow 绘制的字幕保持一致：
+    白色文字、底部居中、最大宽度为画面的 90%，bg_mode 为 dynamic 时带半透明黑色底框，并带淡入淡出
+
+    Args:
+        frame_size: 画面尺寸 (width, height)，作为 PlayRes，字号与边距均按像素计算
+        bottom_margin: 文字底边到画面底边的距离
+        box_padding: 底框在文字四周的留白
+    """
+    width, height = frame_size
+    margin_lr = int(width * 0.05)
+    if bg_mode == "dynamic":
+        # BorderStyle=3 为不透明底框，底框颜色取 OutlineColour；alpha 0x69 约等于 Pillow 中的 150/255 不透明度
+        border_style, outline, box_colour = 3, box_padding, "&H69000000"
+    else:
+        border_style, outline, box_colour = 1, 0, "&H00000000"
+
+    header = f"""[Script Info]
+ScriptType: v4.00+
+PlayResX: {width}
+PlayResY: {height}
+WrapStyle: 0
+ScaledBorderAndShadow: yes
+
+[V4+ Styles]
+Format: Name, Fontname, Fontsize, PrimaryColour, SecondaryColour, OutlineColour, BackColour, Bold, Italic, Underline, StrikeOut, ScaleX, ScaleY, Spacing, Angle, BorderStyle, Outline, Shadow, Alignment, MarginL, MarginR, MarginV, Encoding
+Style: Default,{font_name},{font_size},&H00FFFFFF,&H00FFFFFF,{box_colour},{box_colour},0,0,0,0,100,100,0,0,{border_style},{outline},0,2,{margin_lr},{margin_lr},{bottom_margin},1
+
+[Events]
+Format: Layer, Start, End, Style, Name, MarginL, MarginR, MarginV, Effect, Text
+"""
+    fade_ms = int(fade * 1000)
+    events = []
+    for sub in subtitles:
+        text = sub["text"].strip().replace("\n", "\\N").replace("{", "｛").replace("}", "｝")
+        events.append(
+            f"Dialogue: 0,{format_ass_time(sub['start'])},{format_ass_time(sub['end'])},Default,,0,0,0,,"
+            f"{{\\fad({fade_ms},{fade_ms})}}{text}"
+        )
+    with open(ass_path, "w", encoding="utf-8") as f:
+        f.write(header + "\n".join(events) + "\n")
+    logging.info(f"ASS 字幕已保存到 {ass_path}")
+
+def escape_filter_path(path):
+    """ffmpeg 滤镜参数中的路径需转义冒号、反斜杠和单引号"""
+    path = os.path.abspath(path).replace("\\", "/")
+    return path.replace(":", "\\:").replace("'", "\\'")
+
+def ass_filter(ass_path, fonts_dir):
+    """生成 libass 烧录字幕所用的 ass 滤镜"""
+    return f"ass=filename={escape_filter_path(ass_path)}:fontsdir={escape_filter_path(fonts_dir)}"
@@ -6,6 +6,7 @@ import subprocess
 import logging
 import string
 import sys
+from utils.json_stream import parse_json_array
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 
 def prepare_data(config, story_name):
@@ -84,32 +85,38 @@ def safe_extract_json(content: str) -> list:
     except json.JSONDecodeError:
         pass
 
-    # 2. 正则提取以 [ 开头、以 ] 结尾的部分
-    match = re.search(r"\[\s*\{.*?\}\s*\]", content, re.DOTALL)
-    if match:
-        try:
-            data = json.loads(match.group(0))
-            if isinstance(data, list):
-                return data
-        except json.JSONDecodeError:
-            pass
+    # 2. 跳过前后的说明文字，按括号与字符串状态找出完整的 JSON 数组
+    data = parse_json_array(content)
+    if data is not None:
+        return data
 
     # 3. 提取失败
     raise ValueError("未能从模型输出中提取出合法的 JSON 列表")
 
+ZH_NOISE_PATTERN = re.compile(
+    r"[！？｡。，“”‘’；：《》〈〉、·—…（）【】]"
+    r"|[!?,.:;\"'()\[\]{}<>/~`@#$%^&*_+=\\|-]"
+    r"|\s+"
+)
+
 def clean_zh_text(text: str) -> str:
     """
     清洗中文文本：去除标点、空格、换行等干扰字符
     """
-    # 去除中文和英文标点
-    text = re.sub(r"[！？｡。，“”‘’；：《》〈〉、·—…（）【】]", "", text)
-    text = re.sub(r"[!?,.:;\"'()\[\]{}<>/~`@#$%^&*_+=\\|-]", "", text)
-
-    # 去除所有空白符
-    text = re.sub(r"\s+", "", text)
+    # 一次性去除中文标点、英文标点和所有空白符
+    text = ZH_NOISE_PATTERN.sub("", text)
 
     return text.strip()
 
+CJK_PATTERN = re.compile(r"[\u3000-\u9fff\uff00-\uffef]")
+
+def estimate_tokens(text: str) -> int:
+    """
+    粗略估算文本的 token 数：中日韩字符及全角标点按每字 1 个 token，其余字符按每 4 个字符 1 个 token
+    """
+    cjk = len(CJK_PATTERN.findall(text))
+    return cjk + (len(text) - cjk + 3) // 4
+
 def clean_en_text(text: str) -> str:
     """
     清洗英文文本：小写化，去除标点和多余空白